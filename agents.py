@@ -1,7 +1,8 @@
 from utils import *
 from tools import *
 from inference import *
-import random, string
+import random, string, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 
 def extract_json_between_markers(llm_output):
@@ -33,8 +34,33 @@ def extract_json_between_markers(llm_output):
 
 
 
-def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attempts=3, openai_api_key=None):
+# persistent review scores, see _review_score_cache
+REVIEW_SCORE_CACHE = None
+_REVIEW_SCORE_CACHE_LOCK = threading.Lock()
+
+
+def _review_score_cache():
+    """
+    Cache of (score, review text) by plan, latex, reviewer type, model and temperature, under CACHE_DIR
+    @return: (ResponseCache) cache
+    """
+    global REVIEW_SCORE_CACHE
+    with _REVIEW_SCORE_CACHE_LOCK:
+        if REVIEW_SCORE_CACHE is None:
+            REVIEW_SCORE_CACHE = ResponseCache(os.path.join(CACHE_DIR, "review_scores.sqlite"))
+    return REVIEW_SCORE_CACHE
+
+
+def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attempts=3, openai_api_key=None, use_cache=True):
     e = str()
+    if reviewer_type is None: reviewer_type = ""
+    # a paper already scored by this reviewer (e.g. reverted after a failed edit) is not reviewed again
+    cache_key = ResponseCache.make_key("review", outlined_plan, latex, reviewer_type, f"{reward_model_llm}", 0.0) if use_cache else None
+    if cache_key is not None:
+        cached = _review_score_cache().get(cache_key)
+        if cached is not None:
+            performance, review = json.loads(cached)
+            return performance, review, True
     for _attempt in range(attempts):
         try:
             # todo: have a reward function here
@@ -134,18 +160,20 @@ def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attemp
 
                   You must make sure that all sections are properly created: abstract, introduction, methods, results, and discussion. Points must be reduced from your scores if any of these are missing.
                 """ + template_instructions)
-            if reviewer_type is None: reviewer_type = ""
+            # the review form is shared by every reviewer and the paper by every reviewer of it, the reviewer type goes last
             sys = (
                       "You are an AI researcher who is reviewing a paper that was submitted to a prestigious ML venue. "
-                      f"Be critical and cautious in your decision. {reviewer_type}\n"
+                      "Be critical and cautious in your decision.\n"
                   ) + neurips_form
             scoring = query_model(
                 model_str=f"{reward_model_llm}",
-                system_prompt=sys,
+                static_prefix=sys,
+                system_prompt="",
                 openai_api_key=openai_api_key,
                 prompt=(
                     f"Outlined in the following text is the research plan that the machine learning engineer was tasked with building: {outlined_plan}\n\n"
-                    f"The following text is the research latex that the model produced: \n{latex}\n\n"), temp=0.0)
+                    f"The following text is the research latex that the model produced: \n{latex}\n\n"
+                    f"{reviewer_type}\n"), temp=0.0)
             review_json = extract_json_between_markers(scoring)
 
             overall = int(review_json["Overall"]) / 10
@@ -174,34 +202,190 @@ def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attemp
 
             performance = ((
                soundness_weight * soundness + presentation_weight * presentation + confidence_weight * confidence + contribution_weight * contribution + overall_weight * overall + originality_weight * originality + significance * significance_weight + clarity_weight * clarity + quality_weight * quality) / max_score) * 10
-            return performance, f"The performance of your submission is: {performance}" + scoring, True
+            review = f"The performance of your submission is: {performance}" + scoring
+            if cache_key is not None: _review_score_cache().put(cache_key, json.dumps([performance, review]))
+            return performance, review, True
         except Exception as e:
             print(e)
             return None, str(e), False
     return 0, e
 
 
+# reviewer personas, one per reviewer: the panel size is capped at the number of personas
+REVIEWER_TYPES = [
+    "You are a harsh but fair reviewer and expect good experiments that lead to insights for the research topic.",
+    "You are a harsh and critical but fair reviewer who is looking for an idea that would be impactful in the field.",
+    "You are a harsh but fair open-minded reviewer that is looking for novel ideas that have not been proposed before.",
+    "You are a harsh but fair reviewer who checks that the claims are supported by the experiments and the methodology is sound.",
+    "You are a harsh but fair reviewer who cares about the clarity of the writing and the reproducibility of the results.",
+]
+
+
 class ReviewersAgent:
-    def __init__(self, model="gpt-4o-mini", notes=None, openai_api_key=None):
+    def __init__(self, model="gpt-4o-mini", notes=None, openai_api_key=None, num_reviewers=3):
         if notes is None: self.notes = []
         else: self.notes = notes
         self.model = model
         self.openai_api_key = openai_api_key
+        # each reviewer needs its own persona, a repeated one gives the same (cached) review at temperature 0
+        if not 1 <= num_reviewers <= len(REVIEWER_TYPES):
+            raise Exception(f"num_reviewers must be between 1 and {len(REVIEWER_TYPES)}, the number of reviewer personas")
+        self.num_reviewers = num_reviewers
 
     def inference(self, plan, report):
-        reviewer_1 = "You are a harsh but fair reviewer and expect good experiments that lead to insights for the research topic."
-        review_1 = get_score(outlined_plan=plan, latex=report, reward_model_llm=self.model, reviewer_type=reviewer_1, openai_api_key=self.openai_api_key)
+        # reviews are independent, so the whole panel is queried at once
+        reviewer_types = REVIEWER_TYPES[:self.num_reviewers]
+        with ThreadPoolExecutor(max_workers=max(1, len(reviewer_types))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, get_score, outlined_plan=plan, latex=report, reward_model_llm=self.model,
+                                       reviewer_type=reviewer_type, openai_api_key=self.openai_api_key) for reviewer_type in reviewer_types]
+            reviews = [future.result() for future in futures]
+        return ", \n".join([f"Reviewer #{_i + 1}:\n{review}" for _i, review in enumerate(reviews)])
+
+
+class AgentHistory:
+    def __init__(self, entries=(), max_tokens=None, tokenizer="o200k_base"):
+        """
+        Conversation history of an agent, (steps until expiration or None, text) entries with their token counts.
+        The joined history string is kept between calls and only rebuilt when an entry is removed from the middle.
+        Iterating yields (expiration, text) tuples, like the list it replaces.
+        @param entries: (iterable) initial (expiration, text) entries
+        @param max_tokens: (int) token budget, oldest entries are dropped to fit it, None for no budget
+        @param tokenizer: (str) tiktoken encoding used to count tokens
+        """
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer
+        self.total_tokens = 0
+        self._entries = list()
+        self._joined = str()
+        for entry in entries: self.append(entry)
 
-        reviewer_2 = "You are a harsh and critical but fair reviewer who is looking for an idea that would be impactful in the field."
-        review_2 = get_score(outlined_plan=plan, latex=report, reward_model_llm=self.model, reviewer_type=reviewer_2, openai_api_key=self.openai_api_key)
+    def __len__(self):
+        return len(self._entries)
 
-        reviewer_3 = "You are a harsh but fair open-minded reviewer that is looking for novel ideas that have not been proposed before."
-        review_3 = get_score(outlined_plan=plan, latex=report, reward_model_llm=self.model, reviewer_type=reviewer_3, openai_api_key=self.openai_api_key)
+    def __iter__(self):
+        return iter([(expiration, text) for expiration, text, _ in self._entries])
 
-        return f"Reviewer #1:\n{review_1}, \nReviewer #2:\n{review_2}, \nReviewer #3:\n{review_3}"
+    def __getitem__(self, idx):
+        expiration, text, _ = self._entries[idx]
+        return expiration, text
+
+    def _count(self, text):
+        return len(get_encoding(self.tokenizer).encode(text, disallowed_special=()))
+
+    def append(self, entry):
+        """
+        Add an (expiration, text) entry, truncating it to the token budget and dropping old entries to fit
+        @param entry: (tuple) (steps until expiration or None, text)
+        @return: None
+        """
+        expiration, text = entry
+        tokens = self._count(text)
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            text = get_encoding(self.tokenizer).decode(get_encoding(self.tokenizer).encode(text, disallowed_special=())[:self.max_tokens]) + " [truncated]"
+            tokens = self._count(text)
+        if len(self._entries) == 0: self._joined = text
+        elif self._joined is not None: self._joined += "\n" + text
+        self._entries.append([expiration, text, tokens])
+        self.total_tokens += tokens
+        self.fit()
+
+    def pop(self, idx=-1):
+        expiration, text, tokens = self._entries.pop(idx)
+        self.total_tokens -= tokens
+        if len(self._entries) == 0: self._joined = str()
+        elif self._joined is None: pass
+        elif idx == 0: self._joined = self._joined[len(text) + 1:]
+        elif idx == -1 or idx == len(self._entries): self._joined = self._joined[:len(self._joined) - len(text) - 1]
+        else: self._joined = None
+        return expiration, text
+
+    def fit(self, max_tokens=None):
+        """
+        Drop the oldest entries until the history fits in the token budget (the latest entry is always kept)
+        @param max_tokens: (int) new token budget, None to keep the current one
+        @return: None
+        """
+        if max_tokens is not None: self.max_tokens = max_tokens
+        while self.max_tokens is not None and self.total_tokens > self.max_tokens and len(self._entries) > 1:
+            self.pop(0)
+
+    def expire(self):
+        """
+        Count down entries with an expiration and remove the expired ones
+        @return: None
+        """
+        for _i in reversed(range(len(self._entries))):
+            if self._entries[_i][0] is not None:
+                self._entries[_i][0] -= 1
+                if self._entries[_i][0] < 0:
+                    self.pop(_i)
+
+    def clear(self):
+        self._entries.clear()
+        self._joined = str()
+        self.total_tokens = 0
+
+    def oldest(self, keep=3):
+        """
+        Entries to compact into a summary: every entry without an expiration except the keep most recent
+        @param keep: (int) number of recent entries left verbatim
+        @return: (list) opaque entry handles for compact
+        """
+        return [entry for entry in self._entries[:max(0, len(self._entries) - keep)] if entry[0] is None]
+
+    def compact(self, entries, summary):
+        """
+        Replace entries (from oldest) still in the history by a summary entry placed first
+        @param entries: (list) entry handles returned by oldest
+        @param summary: (str) summary text
+        @return: None
+        """
+        remaining = [entry for entry in self._entries if not any(entry is old for old in entries)]
+        if len(remaining) == len(self._entries):
+            return
+        tokens = self._count(summary)
+        self._entries = [[None, summary, tokens]] + remaining
+        self.total_tokens = sum([entry[2] for entry in self._entries])
+        self._joined = None
+
+    def text(self):
+        """
+        History entries joined by newlines
+        @return: (str) history string
+        """
+        if self._joined is None:
+            self._joined = "\n".join([text for _, text, _ in self._entries])
+        return self._joined
+
+
+# rolling summarization of aged agent history, off unless a model is set, see configure_history_summary
+HISTORY_SUMMARY_MODEL = None
+HISTORY_SUMMARY_TOKENS = 6000
+HISTORY_SUMMARY_KEEP = 3
+_SUMMARY_EXECUTOR = None
+
+
+def configure_history_summary(model="gpt-4o-mini", threshold=6000, keep=3):
+    """
+    Summarize the older history of agents once it exceeds threshold tokens. The summary is made by a cheap
+    model in the background while the agent takes its next step, then replaces the summarized entries.
+    @param model: (str) model used for summaries, None to turn summarization off
+    @param threshold: (int) history tokens above which older entries are summarized
+    @param keep: (int) number of recent entries never summarized
+    @return: None
+    """
+    global HISTORY_SUMMARY_MODEL, HISTORY_SUMMARY_TOKENS, HISTORY_SUMMARY_KEEP, _SUMMARY_EXECUTOR
+    HISTORY_SUMMARY_MODEL = model
+    HISTORY_SUMMARY_TOKENS = threshold
+    HISTORY_SUMMARY_KEEP = keep
+    if model is not None and _SUMMARY_EXECUTOR is None:
+        _SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="history-summary")
 
 
 class BaseAgent:
+    # attributes set on every step which the prompt pieces do not depend on, see prompt_pieces
+    _PROMPT_CACHE_IGNORED = ("history", "prev_comm", "_prompt_cache", "_history_summary")
+
     def __init__(self, model="gpt-4o-mini", notes=None, max_steps=100, openai_api_key=None):
         if notes is None: self.notes = []
         else: self.notes = notes
@@ -210,7 +394,7 @@ class BaseAgent:
         self.phases = []
         self.plan = str()
         self.report = str()
-        self.history = list()
+        self.history = AgentHistory()
         self.prev_comm = str()
         self.prev_report = str()
         self.exp_results = str()
@@ -226,6 +410,34 @@ class BaseAgent:
 
         self.second_round = False
         self.max_hist_len = 15
+        # token budget of the history, per phase in phase_hist_tokens (e.g. {"literature review": 20000}) or max_hist_tokens
+        self.max_hist_tokens = 16000
+        self.phase_hist_tokens = dict()
+        # pending background summary of old history entries, (future, summarized entries)
+        self._history_summary = None
+        # (phase, number of notes) -> (static prompt, context)
+        self._prompt_cache = dict()
+
+    def __setattr__(self, name, value):
+        # any other attribute (plan, dataset_code, lit_review_sum, ...) can change the prompt pieces
+        if name not in self._PROMPT_CACHE_IGNORED and "_prompt_cache" in self.__dict__:
+            self._prompt_cache.clear()
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_history_summary"] = None
+        state["_prompt_cache"] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_history_summary" not in state: self._history_summary = None
+        if "_prompt_cache" not in state: self._prompt_cache = dict()
+        # agents saved before AgentHistory kept their history in a list
+        if type(self.history) == list: self.history = AgentHistory(self.history)
+        if "max_hist_tokens" not in state: self.max_hist_tokens = 16000
+        if "phase_hist_tokens" not in state: self.phase_hist_tokens = dict()
 
     def set_model_backbone(self, model):
         self.model = model
@@ -244,20 +456,44 @@ class BaseAgent:
         model_resp = query_model(model_str=self.model, system_prompt=sys_prompt, prompt=query, temp=temp, openai_api_key=self.openai_api_key)
         return model_resp
 
+    def prompt_pieces(self, research_topic, phase):
+        """
+        Static prompt (role, phase prompt, commands, objective, notes) and context of a phase.
+        Built once and reused until an agent attribute is set or a note is added, which also keeps
+        the static prompt byte-identical across steps for provider prompt caching.
+        @param research_topic: (str) research topic
+        @param phase: (str) current phase
+        @return: (tuple) (static prompt, context)
+        """
+        key = (research_topic, phase, len(self.notes))
+        if key not in self._prompt_cache:
+            phase_notes = [_note for _note in self.notes if phase in _note["phases"]]
+            notes_str = f"Notes for the task objective: {phase_notes}\n" if len(phase_notes) > 0 else ""
+            # everything that stays fixed during a phase goes first, so the provider can cache this prefix across steps
+            static_prompt = (
+                f"""You are {self.role_description()} \nTask instructions: {self.phase_prompt(phase)}\n{self.command_descriptions(phase)}\n"""
+                f"[Objective] Your goal is to perform research on the following topic: {research_topic}\n"
+                f"Notes: {notes_str}\n")
+            self._prompt_cache[key] = (static_prompt, self.context(phase))
+        return self._prompt_cache[key]
+
+    def clear_prompt_cache(self):
+        """
+        Drop the cached prompt pieces, for changes made in place (e.g. appending to a list attribute)
+        @return: None
+        """
+        self._prompt_cache.clear()
+
     def inference(self, research_topic, phase, step, feedback="", temp=None):
-        sys_prompt = f"""You are {self.role_description()} \nTask instructions: {self.phase_prompt(phase)}\n{self.command_descriptions(phase)}"""
-        context = self.context(phase)
-        history_str = "\n".join([_[1] for _ in self.history])
-        phase_notes = [_note for _note in self.notes if phase in _note["phases"]]
-        notes_str = f"Notes for the task objective: {phase_notes}\n" if len(phase_notes) > 0 else ""
+        static_prompt, context = self.prompt_pieces(research_topic, phase)
+        history_str = self.history.text()
         complete_str = str()
         if step/(self.max_steps-1) > 0.7: complete_str = "You must finish this task and submit as soon as possible!"
         prompt = (
             f"""{context}\n{'~' * 10}\nHistory: {history_str}\n{'~' * 10}\n"""
             f"Current Step #{step}, Phase: {phase}\n{complete_str}\n"
-            f"[Objective] Your goal is to perform research on the following topic: {research_topic}\n"
-            f"Feedback: {feedback}\nNotes: {notes_str}\nYour previous command was: {self.prev_comm}. Make sure your new output is very different.\nPlease produce a single command below:\n")
-        model_resp = query_model(model_str=self.model, system_prompt=sys_prompt, prompt=prompt, temp=temp, openai_api_key=self.openai_api_key)
+            f"Feedback: {feedback}\nYour previous command was: {self.prev_comm}. Make sure your new output is very different.\nPlease produce a single command below:\n")
+        model_resp = query_model(model_str=self.model, static_prefix=static_prompt, system_prompt="", prompt=prompt, temp=temp, openai_api_key=self.openai_api_key, stop_when=action_block_closed)
         print("^"*50, phase, "^"*50)
         model_resp = self.clean_text(model_resp)
         self.prev_comm = model_resp
@@ -265,20 +501,41 @@ class BaseAgent:
         if feedback is not None and "```EXPIRATION" in feedback:
             steps_exp = int(feedback.split("\n")[0].replace("```EXPIRATION ", ""))
             feedback = extract_prompt(feedback, "EXPIRATION")
+        self.history.fit(self.phase_hist_tokens.get(phase, self.max_hist_tokens))
         self.history.append((steps_exp, f"Step #{step}, Phase: {phase}, Feedback: {feedback}, Your response: {model_resp}"))
         # remove histories that have expiration dates
-        for _i in reversed(range(len(self.history))):
-            if self.history[_i][0] is not None:
-                self.history[_i] = (self.history[_i][0] - 1, self.history[_i][1])
-                if self.history[_i][0] < 0:
-                    self.history.pop(_i)
+        self.history.expire()
         if len(self.history) >= self.max_hist_len:
             self.history.pop(0)
+        self.summarize_history()
         return model_resp
 
     def reset(self):
         self.history.clear()  # Clear the deque
         self.prev_comm = ""
+        self._history_summary = None
+
+    def summarize_history(self):
+        """
+        Swap in a finished background summary, then start a new one if the history is over HISTORY_SUMMARY_TOKENS
+        @return: None
+        """
+        if self._history_summary is not None and self._history_summary[0].done():
+            future, entries = self._history_summary
+            self._history_summary = None
+            try: self.history.compact(entries, f"Summary of earlier steps: {future.result()}")
+            except Exception as e: print(f"History summary failed: {e}")
+        if HISTORY_SUMMARY_MODEL is None or self._history_summary is not None: return
+        if self.history.total_tokens <= HISTORY_SUMMARY_TOKENS: return
+        entries = self.history.oldest(HISTORY_SUMMARY_KEEP)
+        if len(entries) < 2: return
+        prompt = "\n".join([entry[1] for entry in entries])
+        sys_prompt = (
+            f"You are summarizing the history of {self.role_description()} "
+            "Keep every decision, result, number, dataset, paper id and error that later steps may need, drop everything else. Reply with the summary only.")
+        future = _SUMMARY_EXECUTOR.submit(contextvars.copy_context().run, query_model, model_str=HISTORY_SUMMARY_MODEL,
+                                          system_prompt=sys_prompt, prompt=prompt, temp=0.0, print_cost=False, openai_api_key=self.openai_api_key)
+        self._history_summary = (future, entries)
 
     def context(self, phase):
         raise NotImplementedError("Subclasses should implement this method.")
@@ -303,7 +560,7 @@ class ProfessorAgent(BaseAgent):
 
     def generate_readme(self):
         sys_prompt = f"""You are {self.role_description()} \n Here is the written paper \n{self.report}. Task instructions: Your goal is to integrate all of the knowledge, code, reports, and notes provided to you and generate a readme.md for a github repository."""
-        history_str = "\n".join([_[1] for _ in self.history])
+        history_str = self.history.text()
         prompt = (
             f"""History: {history_str}\n{'~' * 10}\n"""
             f"Please produce the readme below in markdown:\n")
@@ -614,13 +871,15 @@ class PhDStudentAgent(BaseAgent):
                 f"Current Interpretation of results: {self.interpretation}"
             )
         elif phase == "literature review":
-            return sr_str
+            # kept out of the phase prompt, it changes with every paper added
+            if len(self.lit_review) == 0: return sr_str
+            return sr_str + "Papers in your review so far: " + " ".join([_paper["arxiv_id"] for _paper in self.lit_review])
         else:
             return ""
 
     def requirements_txt(self):
         sys_prompt = f"""You are {self.role_description()} \nTask instructions: Your goal is to integrate all of the knowledge, code, reports, and notes provided to you and generate a requirements.txt for a github repository for all of the code."""
-        history_str = "\n".join([_[1] for _ in self.history])
+        history_str = self.history.text()
         prompt = (
             f"""History: {history_str}\n{'~' * 10}\n"""
             f"Please produce the requirements.txt below in markdown:\n")
@@ -679,8 +938,6 @@ class PhDStudentAgent(BaseAgent):
                 "Your goal is to perform a literature review for the presented task and add papers to the literature review.\n"
                 "You have access to arXiv and can perform two search operations: (1) finding many different paper summaries from a search query and (2) getting a single full paper text for an arXiv paper.\n"
             )
-            rev_papers = "Papers in your review so far: " + " ".join([_paper["arxiv_id"] for _paper in self.lit_review])
-            phase_str += rev_papers if len(self.lit_review) > 0 else ""
         elif phase == "plan formulation":
             phase_str = (
                 "You are a PhD student being directed by a postdoc who will help you come up with a good plan, and you interact with them through dialogue.\n"
@@ -726,6 +983,7 @@ class PhDStudentAgent(BaseAgent):
                 "summary": review_text,
             }
             self.lit_review.append(review_entry)
+            self.clear_prompt_cache()
             return f"Successfully added paper {arxiv_id}", full_text
         except Exception as e:
             return f"Error trying to add review -- bad formatting, try again: {str(e)}. Your provided Arxiv ID might not be valid. Make sure it references a real paper, which can be found using the SUMMARY command.", ""
@@ -17,7 +17,7 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
 class LaboratoryWorkflow:
-    def __init__(self, research_topic, openai_api_key, max_steps=100, num_papers_lit_review=5, agent_model_backbone=f"{DEFAULT_LLM_BACKBONE}", notes=list(), human_in_loop_flag=None, compile_pdf=True, mlesolver_max_steps=3, papersolver_max_steps=5, paper_index=0, except_if_fail=False, parallelized=False, lab_dir=None, lab_index=0, agentRxiv=False, agentrxiv_papers=5):
+    def __init__(self, research_topic, openai_api_key, max_steps=100, num_papers_lit_review=5, agent_model_backbone=f"{DEFAULT_LLM_BACKBONE}", notes=list(), human_in_loop_flag=None, compile_pdf=True, mlesolver_max_steps=3, papersolver_max_steps=5, paper_index=0, except_if_fail=False, parallelized=False, lab_dir=None, lab_index=0, agentRxiv=False, agentrxiv_papers=5, num_reviewers=3):
         """
         Initialize laboratory workflow
         @param research_topic: (str) description of research idea to explore
@@ -25,6 +25,7 @@ class LaboratoryWorkflow:
         @param num_papers_lit_review: (int) number of papers to include in the lit review
         @param agent_model_backbone: (str or dict) model backbone to use for agents
         @param notes: (list) notes for agent to follow during tasks
+        @param num_reviewers: (int) number of reviewers scoring the report, queried concurrently
         """
         self.agentRxiv = agentRxiv
         self.max_prev_papers = 10
@@ -46,6 +47,8 @@ class LaboratoryWorkflow:
         self.review_ovrd_steps = 0 # review steps so far
         self.arxiv_paper_exp_time = 3
         self.reference_papers = list()
+        # chunked full texts read during the literature review
+        self.paper_chunks = PaperChunkIndex()
 
         ##########################################
         ####### COMPUTE BUDGET PARAMETERS ########
@@ -53,6 +56,7 @@ class LaboratoryWorkflow:
         self.num_ref_papers = 1
         self.review_total_steps = 0 # num steps to take if overridden
         self.arxiv_num_summaries = 5
+        self.full_text_chunks = 4
         self.num_agentrxiv_papers = agentrxiv_papers
         self.mlesolver_max_steps = mlesolver_max_steps
         self.papersolver_max_steps = papersolver_max_steps
@@ -91,7 +95,7 @@ class LaboratoryWorkflow:
 
         self.save = True
         self.verbose = True
-        self.reviewers = ReviewersAgent(model=self.model_backbone, notes=self.notes, openai_api_key=self.openai_api_key)
+        self.reviewers = ReviewersAgent(model=self.model_backbone, notes=self.notes, openai_api_key=self.openai_api_key, num_reviewers=num_reviewers)
         self.phd = PhDStudentAgent(model=self.model_backbone, notes=self.notes, max_steps=self.max_steps, openai_api_key=self.openai_api_key)
         self.postdoc = PostdocAgent(model=self.model_backbone, notes=self.notes, max_steps=self.max_steps, openai_api_key=self.openai_api_key)
         self.professor = ProfessorAgent(model=self.model_backbone, notes=self.notes, max_steps=self.max_steps, openai_api_key=self.openai_api_key)
@@ -149,6 +153,7 @@ class LaboratoryWorkflow:
                     if self.verbose: print(f"{'&' * 30}\n[Lab #{self.lab_index} Paper #{self.paper_index}] Beginning subtask: {subtask}\n{'&' * 30}")
                 else:
                     if self.verbose: print(f"{'&'*30}\nBeginning subtask: {subtask}\n{'&'*30}")
+                set_usage_context(lab=self.lab_index, phase=subtask)
                 if type(self.phase_models) == dict:
                     if subtask in self.phase_models:
                         self.set_model(self.phase_models[subtask])
@@ -490,6 +495,10 @@ class LaboratoryWorkflow:
                 query = extract_prompt(resp, "FULL_TEXT")
                 if self.agentRxiv and "AgentRxiv" in query: full_text = GLOBAL_AGENTRXIV.retrieve_full_text(query,)
                 else: full_text = arx_eng.retrieve_full_paper_text(query)
+                # only the passages most relevant to the research topic are shown, not the whole paper
+                num_chunks = self.paper_chunks.add_paper(query, full_text)
+                excerpts = self.paper_chunks.excerpts(self.research_topic, k=self.full_text_chunks, paper_id=query)
+                full_text = f"Excerpts of {query} most relevant to the research topic ({min(self.full_text_chunks, num_chunks)} of {num_chunks} parts):\n{excerpts}"
                 # expiration timer so that paper does not remain in context too long
                 arxiv_paper = f"```EXPIRATION {self.arxiv_paper_exp_time}\n" + full_text + "```"
                 feedback = arxiv_paper
@@ -708,6 +717,26 @@ def parse_yaml(yaml_file_loc):
 
     if 'lab-index' in agentlab_data: parser.lab_index = agentlab_data["lab-index"]
     else: parser.lab_index = 0
+    if 'llm-cache' in agentlab_data: parser.llm_cache = agentlab_data["llm-cache"]
+    else: parser.llm_cache = False
+    if 'rate-limits' in agentlab_data: parser.rate_limits = agentlab_data["rate-limits"]
+    else: parser.rate_limits = None
+    if 'rate-limit-shared' in agentlab_data: parser.rate_limit_shared = agentlab_data["rate-limit-shared"]
+    else: parser.rate_limit_shared = False
+    if 'hedge-requests' in agentlab_data: parser.hedge_requests = agentlab_data["hedge-requests"]
+    else: parser.hedge_requests = False
+    if 'fallback-models' in agentlab_data: parser.fallback_models = agentlab_data["fallback-models"]
+    else: parser.fallback_models = None
+    if 'history-summary-model' in agentlab_data: parser.history_summary_model = agentlab_data["history-summary-model"]
+    else: parser.history_summary_model = None
+    if 'history-summary-tokens' in agentlab_data: parser.history_summary_tokens = agentlab_data["history-summary-tokens"]
+    else: parser.history_summary_tokens = 6000
+    if 'hf-embedding-model' in agentlab_data: parser.hf_embedding_model = agentlab_data["hf-embedding-model"]
+    else: parser.hf_embedding_model = None
+    if 'hf-dense-weight' in agentlab_data: parser.hf_dense_weight = agentlab_data["hf-dense-weight"]
+    else: parser.hf_dense_weight = 0.5
+    if 'num-reviewers' in agentlab_data: parser.num_reviewers = agentlab_data["num-reviewers"]
+    else: parser.num_reviewers = 3
     return parser
 
 
@@ -725,6 +754,15 @@ if __name__ == "__main__":
     agentRxiv = args.agentRxiv.lower() == "true" if type(args.agentRxiv) == str else args.agentRxiv
     construct_agentRxiv = args.construct_agentRxiv.lower() == "true" if type(args.construct_agentRxiv) == str else args.construct_agentRxiv
     lab_index = int(args.lab_index) if type(args.construct_agentRxiv) == str else args.lab_index
+    llm_cache = args.llm_cache.lower() == "true" if type(args.llm_cache) == str else args.llm_cache
+    if llm_cache: enable_response_cache()
+    rate_limit_shared = args.rate_limit_shared.lower() == "true" if type(args.rate_limit_shared) == str else args.rate_limit_shared
+    if args.rate_limits or rate_limit_shared:
+        configure_rate_limits(args.rate_limits, shared_path=os.path.join(CACHE_DIR, "rate_limits.sqlite") if rate_limit_shared else None)
+    hedge_requests = args.hedge_requests.lower() == "true" if type(args.hedge_requests) == str else args.hedge_requests
+    if hedge_requests: configure_hedging(True, args.fallback_models)
+    if args.history_summary_model: configure_history_summary(args.history_summary_model, int(args.history_summary_tokens))
+    if args.hf_embedding_model: configure_hf_search(args.hf_embedding_model, float(args.hf_dense_weight))
 
     try: num_papers_to_write = int(args.num_papers_to_write.lower()) if type(args.num_papers_to_write) == str else args.num_papers_to_write
     except Exception: raise Exception("args.num_papers_lit_review must be a valid integer!")
@@ -734,6 +772,9 @@ if __name__ == "__main__":
     except Exception: raise Exception("args.papersolver_max_steps must be a valid integer!")
     try: mlesolver_max_steps = int(args.mlesolver_max_steps.lower()) if type(args.mlesolver_max_steps) == str else args.mlesolver_max_steps
     except Exception: raise Exception("args.mlesolver_max_steps must be a valid integer!")
+    try: num_reviewers = int(args.num_reviewers)
+    except Exception: raise Exception("args.num_reviewers must be a valid integer!")
+    if not 1 <= num_reviewers <= len(REVIEWER_TYPES): raise Exception(f"args.num_reviewers must be between 1 and {len(REVIEWER_TYPES)}!")
     if parallel_labs:
         num_parallel_labs = int(args.num_parallel_labs)
         print("="*20 , f"RUNNING {num_parallel_labs} LABS IN PARALLEL", "="*20)
@@ -811,7 +852,8 @@ if __name__ == "__main__":
                     except_if_fail=except_if_fail,
                     lab_dir=lab_dir,
                     agentRxiv=True,
-                    agentrxiv_papers=args.agentrxiv_papers
+                    agentrxiv_papers=args.agentrxiv_papers,
+                    num_reviewers=num_reviewers
                 )
                 lab_instance.perform_research()
                 time_str += str(time.time() - time_now) + " | "
@@ -856,7 +898,8 @@ if __name__ == "__main__":
                 except_if_fail=except_if_fail,
                 agentRxiv=False,
                 lab_index=lab_index,
-                lab_dir=f"./{lab_direct}"
+                lab_dir=f"./{lab_direct}",
+                num_reviewers=num_reviewers
             )
             lab.perform_research()
             time_str += str(time.time() - time_now) + " | "
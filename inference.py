@@ -1,38 +1,1107 @@
 import openai
+import httpx
+import random
+import sqlite3
+import asyncio
+import hashlib
+import weakref
+import threading
+import contextvars
 import time, tiktoken
 from openai import OpenAI
 import os, anthropic, json
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import google.generativeai as genai
 
-TOKENS_IN = dict()
-TOKENS_OUT = dict()
+# location of persistent caches (llm responses, review scores, ...)
+CACHE_DIR = os.getenv("AGENTLAB_CACHE_DIR", ".agentlab_cache")
+
+# max open connections per provider, shared by every client (and lab thread) of that provider
+PROVIDER_MAX_CONNECTIONS = {
+    "openai": 64,
+    "deepseek": 32,
+    "anthropic": 32,
+}
+PROVIDER_BASE_URLS = {
+    "openai": None,
+    "deepseek": "https://api.deepseek.com/v1",
+    "anthropic": None,
+}
+
+_CLIENT_POOL = dict()
+_CLIENT_POOL_LOCK = threading.Lock()
+# async clients and semaphores are bound to the event loop they were created on
+_ASYNC_CLIENT_POOL = weakref.WeakKeyDictionary()
+_ASYNC_SEMAPHORES = weakref.WeakKeyDictionary()
+_GEMINI_CONFIGURED_KEY = None
+
+
+def get_client(provider, api_key=None, base_url=None):
+    """
+    Get a pooled client for a provider, one per (provider, api key, base_url)
+    Clients are thread-safe and keep their connections alive between calls.
+    SDK-level retries are off, retries are handled by RETRY_POLICY in query_model.
+    @param provider: (str) provider name (openai, deepseek, anthropic)
+    @param api_key: (str) api key for the provider
+    @param base_url: (str) base url of the endpoint, defaults to the provider url
+    @return: client object
+    """
+    if base_url is None: base_url = PROVIDER_BASE_URLS.get(provider)
+    key = (provider, api_key, base_url)
+    client = _CLIENT_POOL.get(key)
+    if client is not None:
+        return client
+    with _CLIENT_POOL_LOCK:
+        if key in _CLIENT_POOL:
+            return _CLIENT_POOL[key]
+        max_conn = PROVIDER_MAX_CONNECTIONS.get(provider, 32)
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_conn, max_keepalive_connections=max_conn),
+            timeout=httpx.Timeout(600.0, connect=10.0))
+        if provider == "anthropic":
+            client = anthropic.Anthropic(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        else:
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        _CLIENT_POOL[key] = client
+        return client
+
+
+def _reset_clients_after_fork():
+    """
+    Drop the pooled clients in a forked child (e.g. experiment code run by execute_code): their keep-alive
+    connections belong to the parent, and the pool lock may have been held by another parent thread at fork.
+    The clients are not closed, closing would shut down connections the parent still uses.
+    @return: None
+    """
+    global _CLIENT_POOL_LOCK, _GEMINI_CONFIGURED_KEY
+    _CLIENT_POOL_LOCK = threading.Lock()
+    _CLIENT_POOL.clear()
+    _ASYNC_CLIENT_POOL.clear()
+    _ASYNC_SEMAPHORES.clear()
+    _GEMINI_CONFIGURED_KEY = None
+
+
+if hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+def get_async_client(provider, api_key=None, base_url=None):
+    """
+    Get a pooled async client for a provider on the running event loop
+    @param provider: (str) provider name (openai, deepseek, anthropic)
+    @param api_key: (str) api key for the provider
+    @param base_url: (str) base url of the endpoint, defaults to the provider url
+    @return: async client object
+    """
+    if base_url is None: base_url = PROVIDER_BASE_URLS.get(provider)
+    loop_clients = _ASYNC_CLIENT_POOL.setdefault(asyncio.get_running_loop(), dict())
+    key = (provider, api_key, base_url)
+    if key not in loop_clients:
+        max_conn = PROVIDER_MAX_CONNECTIONS.get(provider, 32)
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_conn, max_keepalive_connections=max_conn),
+            timeout=httpx.Timeout(600.0, connect=10.0))
+        if provider == "anthropic":
+            loop_clients[key] = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        else:
+            loop_clients[key] = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    return loop_clients[key]
+
+
+def configure_gemini(api_key):
+    """
+    Configure the gemini sdk, only when the api key changes (genai.configure is process-global)
+    @param api_key: (str) gemini api key
+    @return: None
+    """
+    global _GEMINI_CONFIGURED_KEY
+    if api_key == _GEMINI_CONFIGURED_KEY:
+        return
+    with _CLIENT_POOL_LOCK:
+        if api_key != _GEMINI_CONFIGURED_KEY:
+            genai.configure(api_key=api_key)
+            _GEMINI_CONFIGURED_KEY = api_key
+
+
+def close_clients():
+    """
+    Close all pooled clients and their connections
+    @return: None
+    """
+    with _CLIENT_POOL_LOCK:
+        for client in _CLIENT_POOL.values():
+            try: client.close()
+            except Exception: pass
+        _CLIENT_POOL.clear()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, max_age=30 * 24 * 3600, evict_every=100):
+        """
+        Persistent content-addressed key/value store backed by SQLite, with LRU eviction.
+        Safe to share between threads and processes (one connection per thread, WAL journal).
+        @param path: (str) location of the sqlite file
+        @param max_bytes: (int) max total size of stored values before least recently used entries are evicted
+        @param max_age: (float) max age in seconds of an entry
+        @param evict_every: (int) run eviction after this many writes
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Hash arbitrary json-serializable parts into a cache key
+        @return: (str) hex digest
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a value, refreshing its LRU position
+        @param key: (str) cache key
+        @return: (str) stored value or None on a miss
+        """
+        conn = self._conn()
+        row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.max_age:
+            self.misses += 1
+            return None
+        conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        """
+        Store a value
+        @param key: (str) cache key
+        @param value: (str) value to store
+        @return: None
+        """
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value.encode("utf-8")), now, now))
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries, then least recently used entries until under max_bytes
+        @return: None
+        """
+        conn = self._conn()
+        conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.max_age,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_remove = list()
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC"):
+            if total <= self.max_bytes: break
+            to_remove.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM entries WHERE key = ?", to_remove)
+
+    def clear(self):
+        self._conn().execute("DELETE FROM entries")
+
+    def stats(self):
+        """
+        Cache statistics
+        @return: (dict) hits, misses, number of entries and stored bytes
+        """
+        entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+RESPONSE_CACHE = None
+# only cache temperature 0.0 requests unless told otherwise, sampled answers should stay diverse
+RESPONSE_CACHE_DETERMINISTIC_ONLY = True
+
+
+def enable_response_cache(path=None, max_bytes=512 * 1024 * 1024, max_age=30 * 24 * 3600, deterministic_only=True):
+    """
+    Turn on the persistent llm response cache used by query_model
+    @param path: (str) location of the sqlite file, defaults to CACHE_DIR/llm_responses.sqlite
+    @param max_bytes: (int) max cache size in bytes
+    @param max_age: (float) max age of an entry in seconds
+    @param deterministic_only: (bool) only cache requests made with temperature 0.0
+    @return: (ResponseCache) the cache
+    """
+    global RESPONSE_CACHE, RESPONSE_CACHE_DETERMINISTIC_ONLY
+    if path is None: path = os.path.join(CACHE_DIR, "llm_responses.sqlite")
+    RESPONSE_CACHE = ResponseCache(path, max_bytes=max_bytes, max_age=max_age)
+    RESPONSE_CACHE_DETERMINISTIC_ONLY = deterministic_only
+    return RESPONSE_CACHE
+
+
+def disable_response_cache():
+    global RESPONSE_CACHE
+    RESPONSE_CACHE = None
+
+
+def _response_cache_key(spec, prompt, system_prompt, temp, use_cache, stop_when=None):
+    """
+    Cache key for a request, or None if the request should not be cached
+    """
+    if RESPONSE_CACHE is None or not use_cache:
+        return None
+    if RESPONSE_CACHE_DETERMINISTIC_ONLY and temp != 0.0:
+        return None
+    parts = (spec.provider, spec.base_url, spec.model_id, system_prompt, prompt, temp, spec.max_tokens)
+    # answers cut short by a stop predicate are stored apart from full answers
+    if stop_when is not None: parts += (getattr(stop_when, "__qualname__", repr(stop_when)),)
+    return ResponseCache.make_key(*parts)
+
+
+class RetryPolicy:
+    def __init__(self, base_delay=1.0, max_delay=60.0):
+        """
+        Classifies request errors and computes jittered exponential backoff delays
+        @param base_delay: (float) delay in seconds before the first retry
+        @param max_delay: (float) cap on the backoff delay in seconds
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def classify(error):
+        """
+        Classify a request error
+        @param error: (Exception) error raised by a provider client
+        @return: (str) one of "rate_limit", "overloaded", "timeout", "bad_request", "other"
+        """
+        if isinstance(error, (httpx.TimeoutException, TimeoutError)) or "Timeout" in type(error).__name__:
+            return "timeout"
+        status = getattr(error, "status_code", None)
+        if not isinstance(status, int):
+            status = getattr(error, "code", None)
+        if isinstance(status, int):
+            if status == 429: return "rate_limit"
+            if status in (408, 504): return "timeout"
+            if status == 409: return "other"
+            if status >= 500: return "overloaded"
+            if 400 <= status < 500: return "bad_request"
+        if isinstance(error, (httpx.TransportError, ConnectionError)) or "Connection" in type(error).__name__:
+            return "timeout"
+        return "other"
+
+    @staticmethod
+    def retry_after(error):
+        """
+        Delay requested by the provider through Retry-After headers
+        @param error: (Exception) error raised by a provider client
+        @return: (float) delay in seconds, or None
+        """
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if headers is None:
+            return None
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers.get("retry-after-ms")) / 1000.0
+            if headers.get("retry-after") is not None:
+                return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+        return None
+
+    def delay(self, attempt, error=None):
+        """
+        Delay before the next attempt: Retry-After when given, otherwise full-jitter exponential backoff
+        @param attempt: (int) number of failed attempts so far, starting at 0
+        @param error: (Exception) the last error
+        @return: (float) delay in seconds
+        """
+        retry_after = self.retry_after(error) if error is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        """
+        Stops sending requests to a provider for a cooldown after repeated failures
+        @param failure_threshold: (int) consecutive retryable failures before the breaker opens
+        @param cooldown: (float) seconds the breaker stays open
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """
+        @return: (float) seconds to wait before the next request may be sent
+        """
+        return max(0.0, self.open_until - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                # half-open after the cooldown: one more failure re-opens it
+                self.open_until = time.time() + self.cooldown
+                self.failures = self.failure_threshold - 1
+
+
+RETRY_POLICY = RetryPolicy()
+_BREAKERS = dict()
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_circuit_breaker(provider):
+    with _BREAKERS_LOCK:
+        if provider not in _BREAKERS:
+            _BREAKERS[provider] = CircuitBreaker()
+        return _BREAKERS[provider]
+
+
+class RateLimiter:
+    def __init__(self, path=None, window=60.0):
+        """
+        Token buckets for the requests per minute and tokens per minute of each model.
+        Callers reserve budget before sending and wait the returned delay, which spreads requests
+        out at the provider limit instead of bursting into rate limit errors.
+        With a path the buckets live in SQLite and are shared between processes.
+        @param path: (str) location of the sqlite file, None to keep buckets in this process
+        @param window: (float) length of the rate limit window in seconds
+        """
+        self.path = path
+        self.window = window
+        self._buckets = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path is not None:
+            if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn().execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"], state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _update(self, state, buckets, now):
+        """
+        Refill and debit buckets, the level may go negative: that debt is the wait of the caller
+        @param state: (dict) bucket name -> (level, last update time), updated in place
+        @param buckets: (list) (name, capacity per window, amount to debit)
+        @param now: (float) current time
+        @return: (float) seconds to wait before the reserved request may be sent
+        """
+        wait = 0.0
+        for name, capacity, amount in buckets:
+            rate = capacity / self.window
+            level, updated = state.get(name, (capacity, now))
+            level = min(capacity, level + (now - updated) * rate) - min(amount, capacity)
+            state[name] = (level, now)
+            if level < 0: wait = max(wait, -level / rate)
+        return wait
+
+    def _apply(self, buckets):
+        now = time.time()
+        if self.path is None:
+            with self._lock:
+                return self._update(self._buckets, buckets, now)
+        conn = self._conn()
+        names = [_b[0] for _b in buckets]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                f"SELECT name, level, updated FROM buckets WHERE name IN ({','.join('?' * len(names))})", names)
+            state = {_name: (_level, _updated) for _name, _level, _updated in rows}
+            wait = self._update(state, buckets, now)
+            conn.executemany("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                             [(_name,) + state[_name] for _name in names])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def reserve(self, spec, tokens=0):
+        """
+        Reserve one request and an estimated number of tokens for a model
+        @param spec: (ModelSpec) model spec, its rpm and tpm are the limits
+        @param tokens: (int) estimated input + output tokens of the request
+        @return: (float) seconds to wait before sending
+        """
+        buckets = list()
+        if spec.rpm: buckets.append((f"{spec.name}:rpm", spec.rpm, 1))
+        if spec.tpm: buckets.append((f"{spec.name}:tpm", spec.tpm, tokens))
+        if not buckets: return 0.0
+        return self._apply(buckets)
+
+    def settle(self, spec, estimated, actual):
+        """
+        Correct a token reservation once the real usage is known
+        @param spec: (ModelSpec) model spec
+        @param estimated: (int) tokens reserved
+        @param actual: (int) tokens used
+        @return: None
+        """
+        if spec.tpm and actual != estimated:
+            self._apply([(f"{spec.name}:tpm", spec.tpm, actual - estimated)])
+
+
+RATE_LIMITER = RateLimiter()
+# output tokens assumed when reserving budget for a model without max_tokens
+RATE_LIMIT_OUTPUT_ESTIMATE = 1024
+
+
+def configure_rate_limits(limits=None, shared_path=None):
+    """
+    Set per-model rate limits, shared by every lab thread of this process
+    e.g. configure_rate_limits({"gpt-4o-mini": {"rpm": 5000, "tpm": 2000000}})
+    @param limits: (dict) model name or alias -> {"rpm": int, "tpm": int}
+    @param shared_path: (str) sqlite file to share the buckets with other processes, None for this process only
+    @return: (RateLimiter) the rate limiter
+    """
+    global RATE_LIMITER
+    for model_str, limit in (limits or dict()).items():
+        spec = resolve_model(model_str)
+        spec.rpm = limit.get("rpm")
+        spec.tpm = limit.get("tpm")
+    RATE_LIMITER = RateLimiter(path=shared_path)
+    return RATE_LIMITER
+
+
+class LatencyTracker:
+    def __init__(self, window=200, min_samples=20):
+        """
+        Recent latencies of successful requests per model
+        @param window: (int) number of latencies kept per model
+        @param min_samples: (int) latencies needed before a quantile is reported
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies = dict()
+        self._lock = threading.Lock()
+
+    def record(self, model, seconds):
+        with self._lock:
+            latencies = self._latencies.setdefault(model, deque(maxlen=self.window))
+            latencies.append(seconds)
+
+    def quantile(self, model, q=0.95):
+        """
+        Latency quantile of a model
+        @param model: (str) model name
+        @param q: (float) quantile in [0, 1]
+        @return: (float) latency in seconds, None with fewer than min_samples latencies
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+LATENCY = LatencyTracker()
+# hedged requests in query_model, see configure_hedging
+HEDGE_REQUESTS = False
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_DELAY = 2.0
+# model name -> ordered list of models to hedge / fall back to
+FALLBACK_MODELS = dict()
+_HEDGE_EXECUTOR = None
+_HEDGE_EXECUTOR_LOCK = threading.Lock()
+
+
+def configure_hedging(enabled=True, fallback_models=None, quantile=0.95, min_delay=2.0):
+    """
+    Hedge query_model requests: once a request has taken longer than the model's observed latency
+    quantile a duplicate is sent, to the first fallback model of the model (or the model itself),
+    the first answer wins and the other request is cancelled.
+    e.g. configure_hedging(True, {"o3-mini": ["gpt-4o-mini"]})
+    @param enabled: (bool) hedge requests
+    @param fallback_models: (dict) model name or alias -> list of fallback model names or aliases
+    @param quantile: (float) latency quantile after which the duplicate is sent
+    @param min_delay: (float) minimum seconds before the duplicate is sent
+    @return: None
+    """
+    global HEDGE_REQUESTS, HEDGE_QUANTILE, HEDGE_MIN_DELAY, FALLBACK_MODELS
+    HEDGE_REQUESTS = enabled
+    HEDGE_QUANTILE = quantile
+    HEDGE_MIN_DELAY = min_delay
+    FALLBACK_MODELS = {resolve_model(model_str).name: [resolve_model(fallback).name for fallback in fallbacks]
+                       for model_str, fallbacks in (fallback_models or dict()).items()}
+
+
+def _hedge_executor():
+    global _HEDGE_EXECUTOR
+    with _HEDGE_EXECUTOR_LOCK:
+        if _HEDGE_EXECUTOR is None:
+            _HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=64, thread_name_prefix="hedge")
+        return _HEDGE_EXECUTOR
+
+
+class ModelSpec:
+    def __init__(self, name, provider, model_id, aliases=(), prompt_layout="system", tokenizer="o200k_base",
+                 cost_in=0.0, cost_out=0.0, cost_cached=None, max_concurrency=16, supports_temperature=True, base_url=None,
+                 api_key_env=None, max_tokens=None, rpm=None, tpm=None, supports_streaming=True, supports_n=False):
+        """
+        Description of a model backend
+        @param name: (str) canonical model name, used for accounting
+        @param provider: (str) provider name (openai, deepseek, anthropic, gemini)
+        @param model_id: (str) dated model id sent to the provider
+        @param aliases: (tuple) other names which resolve to this model
+        @param prompt_layout: (str) "system" for system + user messages, "user" for system prompt prepended to the user message
+        @param tokenizer: (str) tiktoken encoding used to approximate token counts
+        @param cost_in: (float) price per input token in dollars
+        @param cost_out: (float) price per output token in dollars
+        @param cost_cached: (float) price per input token read from the provider prompt cache, defaults to cost_in
+        @param max_concurrency: (int) max number of in-flight requests for this model
+        @param supports_temperature: (bool) whether temperature can be set
+        @param base_url: (str) endpoint url, e.g. for local OpenAI-compatible servers
+        @param api_key_env: (str) environment variable holding the api key, overrides the provider default
+        @param max_tokens: (int) max output tokens, required by some providers
+        @param rpm: (int) requests per minute allowed by the provider, None for no limit
+        @param tpm: (int) tokens per minute allowed by the provider, None for no limit
+        @param supports_streaming: (bool) whether completions can be streamed
+        @param supports_n: (bool) whether one request can return several samples (n), otherwise they are emulated
+        """
+        self.name = name
+        self.provider = provider
+        self.model_id = model_id
+        self.aliases = tuple(aliases)
+        self.prompt_layout = prompt_layout
+        self.tokenizer = tokenizer
+        self.cost_in = cost_in
+        self.cost_out = cost_out
+        self.cost_cached = cost_in if cost_cached is None else cost_cached
+        self.max_concurrency = max_concurrency
+        self.supports_temperature = supports_temperature
+        self.base_url = base_url
+        self.api_key_env = api_key_env
+        self.max_tokens = max_tokens
+        self.rpm = rpm
+        self.tpm = tpm
+        self.supports_streaming = supports_streaming
+        self.supports_n = supports_n
+
+
+MODEL_REGISTRY = dict()
+_MODEL_ALIASES = dict()
+
+
+def register_model(name, provider, model_id, **kwargs):
+    """
+    Add a model backend to the registry (or replace an existing one)
+    @param name: (str) canonical model name
+    @param provider: (str) provider name
+    @param model_id: (str) model id sent to the provider
+    @param kwargs: other ModelSpec fields
+    @return: (ModelSpec) registered spec
+    """
+    spec = ModelSpec(name, provider, model_id, **kwargs)
+    MODEL_REGISTRY[name] = spec
+    _MODEL_ALIASES[name] = name
+    for alias in spec.aliases:
+        _MODEL_ALIASES[alias] = name
+    return spec
+
+
+def resolve_model(model_str):
+    """
+    Resolve a model name or alias to its spec
+    @param model_str: (str) model name or alias
+    @return: (ModelSpec) model spec
+    """
+    if model_str not in _MODEL_ALIASES:
+        raise Exception(f"Unknown model: {model_str}, supported models are {list(MODEL_REGISTRY)}")
+    return MODEL_REGISTRY[_MODEL_ALIASES[model_str]]
+
+
+register_model("gpt-4o-mini", "openai", "gpt-4o-mini-2024-07-18", aliases=("gpt4omini", "gpt-4omini", "gpt4o-mini"), supports_n=True,
+               cost_in=0.150 / 1000000, cost_out=0.6 / 1000000, cost_cached=0.075 / 1000000)
+register_model("gpt-4o", "openai", "gpt-4o-2024-08-06", aliases=("gpt4o",), supports_n=True,
+               cost_in=2.50 / 1000000, cost_out=10.00 / 1000000, cost_cached=1.25 / 1000000)
+register_model("o1-preview", "openai", "o1-preview", prompt_layout="user", supports_temperature=False,
+               supports_streaming=False,
+               cost_in=15.00 / 1000000, cost_out=60.00 / 1000000, cost_cached=7.50 / 1000000)
+register_model("o1-mini", "openai", "o1-mini-2024-09-12", prompt_layout="user", supports_temperature=False,
+               supports_streaming=False,
+               cost_in=3.00 / 1000000, cost_out=12.00 / 1000000, cost_cached=1.50 / 1000000)
+register_model("o1", "openai", "o1-2024-12-17", prompt_layout="user", supports_temperature=False,
+               supports_streaming=False,
+               cost_in=15.00 / 1000000, cost_out=60.00 / 1000000, cost_cached=7.50 / 1000000)
+register_model("o3-mini", "openai", "o3-mini-2025-01-31", prompt_layout="user", supports_temperature=False,
+               cost_in=1.10 / 1000000, cost_out=4.40 / 1000000, cost_cached=0.55 / 1000000)
+register_model("claude-3.5-sonnet", "anthropic", "claude-3-5-sonnet-latest", max_tokens=8192,
+               cost_in=3.00 / 1000000, cost_out=12.00 / 1000000, cost_cached=0.30 / 1000000)
+register_model("deepseek-chat", "deepseek", "deepseek-chat", tokenizer="cl100k_base", api_key_env="DEEPSEEK_API_KEY",
+               cost_in=1.00 / 1000000, cost_out=5.00 / 1000000, cost_cached=0.10 / 1000000)
+register_model("gemini-1.5-pro", "gemini", "gemini-1.5-pro", tokenizer="cl100k_base",
+               cost_in=1.25 / 1000000, cost_out=5.00 / 1000000)
+register_model("gemini-2.0-pro", "gemini", "gemini-2.0-pro-exp-02-05", tokenizer="cl100k_base")
+# scripted stand-in server for offline load tests, see llm_server.py
+register_model("local-stub", "openai", "agentlab-stub", aliases=("stub",), max_concurrency=64, supports_n=True,
+               base_url=os.getenv("AGENTLAB_STUB_URL", "http://127.0.0.1:8765/v1"))
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name):
+    return tiktoken.get_encoding(name)
+
+
+class _ShardOwner:
+    # kept in the thread-local of a UsageLedger writer, collected when the thread ends
+    __slots__ = ("shard", "__weakref__")
+
+
+class UsageLedger:
+    def __init__(self):
+        """
+        Token counters aggregated per (lab, phase, model).
+        Every thread writes only to its own shard so increments need no lock;
+        readers sum over all shards. Shards of finished threads are merged into a base shard,
+        so short-lived pool threads do not grow the walk.
+        """
+        self._base = dict()
+        self._shards = [self._base]
+        self._retired = list()
+        self._local = threading.local()
+        self._register_lock = threading.Lock()
+
+    def _shard(self):
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            owner = _ShardOwner()
+            owner.shard = dict()
+            with self._register_lock:
+                self._shards.append(owner.shard)
+            # only an append, the finalizer may run inside a locked section of this ledger
+            weakref.finalize(owner, self._retired.append, owner.shard)
+            self._local.owner = owner
+        return owner.shard
+
+    def _merge_retired(self):
+        """
+        Fold the shards of finished threads into the base shard, with the register lock held
+        """
+        while self._retired:
+            shard = self._retired.pop()
+            for key, counts in shard.items():
+                base = self._base.setdefault(key, [0] * len(counts))
+                for _i, _count in enumerate(counts):
+                    base[_i] += _count
+            self._shards = [_s for _s in self._shards if _s is not shard]
+
+    def add(self, lab, phase, model, tokens_in, tokens_out, tokens_cached=0, reported=True):
+        """
+        @param reported: (bool) whether the provider reported the usage, only those input tokens count for the cache hit rate
+        """
+        shard = self._shard()
+        key = (lab, phase, model)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0, 0, 0, 0, 0]
+        counts[0] += tokens_in
+        counts[1] += tokens_out
+        counts[2] += tokens_cached
+        counts[3] += 1
+        if reported: counts[4] += tokens_in
+
+    def totals(self, group_by=("model",)):
+        """
+        Sum counters over all threads
+        @param group_by: (tuple) any of "lab", "phase", "model"
+        @return: (dict) group key -> {"in", "out", "cached", "requests", "reported_in"}
+        """
+        fields = ("lab", "phase", "model")
+        totals = dict()
+        # merging moves counts between shards, so it cannot overlap with the walk
+        with self._register_lock:
+            self._merge_retired()
+            for shard in self._shards:
+                for key, counts in list(shard.items()):
+                    group = tuple(key[fields.index(_g)] for _g in group_by)
+                    if group not in totals:
+                        totals[group] = {"in": 0, "out": 0, "cached": 0, "requests": 0, "reported_in": 0}
+                    for _name, _count in zip(("in", "out", "cached", "requests", "reported_in"), counts):
+                        totals[group][_name] += _count
+        return totals
+
+    def cost(self, group_by=()):
+        """
+        Approximate cost in dollars
+        @param group_by: (tuple) any of "lab", "phase"
+        @return: (float or dict) total cost, or group key -> cost
+        """
+        costs = dict()
+        for key, counts in self.totals(group_by=tuple(group_by) + ("model",)).items():
+            spec = MODEL_REGISTRY.get(key[-1])
+            if spec is None: continue
+            cost = spec.cost_in * (counts["in"] - counts["cached"]) + spec.cost_cached * counts["cached"] + spec.cost_out * counts["out"]
+            costs[key[:-1]] = costs.get(key[:-1], 0.0) + cost
+        if len(group_by) == 0: return costs.get((), 0.0)
+        return costs
+
+    def cache_hit_rate(self, group_by=()):
+        """
+        Fraction of input tokens served from the provider prompt cache, over the requests whose usage the
+        provider reported (cached tokens of the others are unknown)
+        @param group_by: (tuple) any of "lab", "phase", "model"
+        @return: (float or dict) overall hit rate, or group key -> hit rate
+        """
+        rates = dict()
+        for key, counts in self.totals(group_by=tuple(group_by)).items():
+            rates[key] = counts["cached"] / counts["reported_in"] if counts["reported_in"] > 0 else 0.0
+        if len(group_by) == 0: return rates.get((), 0.0)
+        return rates
+
+    def reset(self):
+        with self._register_lock:
+            self._merge_retired()
+            for shard in self._shards:
+                shard.clear()
+
+
+USAGE = UsageLedger()
+_USAGE_LAB = contextvars.ContextVar("usage_lab", default=None)
+_USAGE_PHASE = contextvars.ContextVar("usage_phase", default=None)
+
+
+def set_usage_context(lab=None, phase=None):
+    """
+    Attribute subsequent requests in this thread / task to a lab and phase
+    @param lab: (int) lab index
+    @param phase: (str) phase or subtask name
+    @return: None
+    """
+    _USAGE_LAB.set(lab)
+    _USAGE_PHASE.set(phase)
 
-encoding = tiktoken.get_encoding("cl100k_base")
 
 def curr_cost_est():
-    costmap_in = {
-        "gpt-4o": 2.50 / 1000000,
-        "gpt-4o-mini": 0.150 / 1000000,
-        "o1-preview": 15.00 / 1000000,
-        "o1-mini": 3.00 / 1000000,
-        "claude-3-5-sonnet": 3.00 / 1000000,
-        "deepseek-chat": 1.00 / 1000000,
-        "o1": 15.00 / 1000000,
-        "o3-mini": 1.10 / 1000000,
-    }
-    costmap_out = {
-        "gpt-4o": 10.00/ 1000000,
-        "gpt-4o-mini": 0.6 / 1000000,
-        "o1-preview": 60.00 / 1000000,
-        "o1-mini": 12.00 / 1000000,
-        "claude-3-5-sonnet": 12.00 / 1000000,
-        "deepseek-chat": 5.00 / 1000000,
-        "o1": 60.00 / 1000000,
-        "o3-mini": 4.40 / 1000000,
-    }
-    return sum([costmap_in[_]*TOKENS_IN[_] for _ in TOKENS_IN]) + sum([costmap_out[_]*TOKENS_OUT[_] for _ in TOKENS_OUT])
-
-def query_model(model_str, prompt, system_prompt, openai_api_key=None, gemini_api_key=None,  anthropic_api_key=None, tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5"):
+    return USAGE.cost()
+
+
+def build_messages(spec, prompt, system_prompt):
+    """
+    Lay out the system prompt and prompt the way the model expects
+    @param spec: (ModelSpec) model spec
+    @param prompt: (str) user prompt
+    @param system_prompt: (str) system prompt
+    @return: (list) chat messages
+    """
+    if spec.prompt_layout == "user":
+        return [{"role": "user", "content": system_prompt + prompt}]
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}]
+
+
+def _provider_api_key(spec, openai_api_key=None, gemini_api_key=None, anthropic_api_key=None):
+    if spec.api_key_env is not None:
+        return os.getenv(spec.api_key_env)
+    if spec.provider == "anthropic":
+        return anthropic_api_key or os.getenv("ANTHROPIC_API_KEY")
+    if spec.provider == "gemini":
+        return gemini_api_key or os.getenv("GEMINI_API_KEY")
+    return openai_api_key
+
+
+def _request_kwargs(spec, prompt, system_prompt, temp=None, static_prefix="", n=1):
+    """
+    Build the provider request arguments for a model
+    @param spec: (ModelSpec) model spec
+    @param prompt: (str) user prompt
+    @param system_prompt: (str) system prompt, sent after the static prefix
+    @param temp: (float) sampling temperature, None for the provider default
+    @param static_prefix: (str) start of the system prompt which is identical across requests
+    @param n: (int) number of samples, only for models with supports_n
+    @return: (dict) keyword arguments for the provider create call
+    """
+    sampling = dict()
+    if temp is not None and spec.supports_temperature:
+        sampling["temperature"] = temp
+    if n > 1:
+        sampling["n"] = n
+    if spec.provider == "anthropic":
+        system = system_prompt
+        if static_prefix:
+            # anthropic only caches prompt prefixes up to an explicit cache_control marker
+            system = [{"type": "text", "text": static_prefix, "cache_control": {"type": "ephemeral"}}]
+            if system_prompt: system.append({"type": "text", "text": system_prompt})
+        return dict(model=spec.model_id, system=system, max_tokens=spec.max_tokens,
+                    messages=[{"role": "user", "content": prompt}], **sampling)
+    elif spec.provider == "gemini":
+        generation_config = genai.types.GenerationConfig(**sampling) if sampling else None
+        return dict(contents=prompt, generation_config=generation_config)
+    # openai and deepseek cache byte-identical prompt prefixes automatically
+    return dict(model=spec.model_id, messages=build_messages(spec, prompt, static_prefix + system_prompt), **sampling)
+
+
+def _response_text(spec, response):
+    if spec.provider == "anthropic":
+        return json.loads(response.to_json())["content"][0]["text"]
+    elif spec.provider == "gemini":
+        return response.text
+    return response.choices[0].message.content
+
+
+def _gemini_model(spec, api_key, system_prompt):
+    configure_gemini(api_key)
+    return genai.GenerativeModel(model_name=spec.model_id, system_instruction=system_prompt)
+
+
+def _complete(spec, prompt, system_prompt, api_key, temp=None, version="1.5", static_prefix="", n=1):
+    """
+    Send a single request to the provider of a model
+    @param spec: (ModelSpec) model spec
+    @param prompt: (str) user prompt
+    @param system_prompt: (str) system prompt
+    @param api_key: (str) provider api key
+    @param temp: (float) sampling temperature, None for the provider default
+    @param version: (str) openai sdk version, "0.28" for the legacy api
+    @param static_prefix: (str) start of the system prompt which is identical across requests
+    @param n: (int) number of samples, only for models with supports_n
+    @return: provider response object
+    """
+    kwargs = _request_kwargs(spec, prompt, system_prompt, temp, static_prefix, n)
+    if spec.provider == "anthropic":
+        return get_client("anthropic", api_key, spec.base_url).messages.create(**kwargs)
+    elif spec.provider == "gemini":
+        return _gemini_model(spec, api_key, static_prefix + system_prompt).generate_content(**kwargs)
+    if version == "0.28":
+        if spec.provider != "openai" or spec.base_url is not None:
+            raise Exception(f"Please upgrade your OpenAI version to use the {spec.provider} client")
+        return openai.ChatCompletion.create(**kwargs)
+    return get_client(spec.provider, api_key, spec.base_url).chat.completions.create(**kwargs)
+
+
+async def _acomplete(spec, prompt, system_prompt, api_key, temp=None, static_prefix=""):
+    """
+    Async counterpart of _complete
+    @return: provider response object
+    """
+    kwargs = _request_kwargs(spec, prompt, system_prompt, temp, static_prefix)
+    if spec.provider == "anthropic":
+        return await get_async_client("anthropic", api_key, spec.base_url).messages.create(**kwargs)
+    elif spec.provider == "gemini":
+        return await _gemini_model(spec, api_key, static_prefix + system_prompt).generate_content_async(**kwargs)
+    return await get_async_client(spec.provider, api_key, spec.base_url).chat.completions.create(**kwargs)
+
+
+def _stream_chunks(spec, prompt, system_prompt, api_key, temp=None, static_prefix="", usage=None):
+    """
+    Stream a single request to the provider of a model
+    Closing the generator closes the connection, which cancels the generation.
+    @param usage: (dict) filled with the provider-reported "in", "out" and "cached" tokens; anthropic reports
+        input tokens when the stream starts, output tokens (and openai / gemini usage) only come once it ends
+    @return: generator of text chunks
+    """
+    if usage is None: usage = dict()
+    kwargs = _request_kwargs(spec, prompt, system_prompt, temp, static_prefix)
+    if spec.provider == "anthropic":
+        with get_client("anthropic", api_key, spec.base_url).messages.stream(**kwargs) as stream:
+            for event in stream:
+                if event.type == "message_start":
+                    reported = _reported_usage(spec, event.message)
+                    if reported is not None: usage["in"], usage["cached"] = reported[0], reported[2]
+                elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                    yield event.delta.text
+            reported = _reported_usage(spec, stream.get_final_message())
+            if reported is not None: usage["in"], usage["out"], usage["cached"] = reported
+        return
+    elif spec.provider == "gemini":
+        chunk = None
+        for chunk in _gemini_model(spec, api_key, static_prefix + system_prompt).generate_content(stream=True, **kwargs):
+            yield chunk.text
+        reported = _reported_usage(spec, chunk) if chunk is not None else None
+        if reported is not None: usage["in"], usage["out"], usage["cached"] = reported
+        return
+    stream = get_client(spec.provider, api_key, spec.base_url).chat.completions.create(
+        stream=True, stream_options={"include_usage": True}, **kwargs)
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, "usage", None) is not None:
+                reported = _reported_usage(spec, chunk)
+                if reported is not None: usage["in"], usage["out"], usage["cached"] = reported
+    finally:
+        stream.close()
+
+
+def _streamed_usage(spec, usage, text):
+    """
+    Usage of a streamed request from what the provider reported before the stream ended
+    @param usage: (dict) usage filled by _stream_chunks
+    @param text: (str) text received, counted when output tokens were not reported
+    @return: (tuple) (input tokens, output tokens, cached input tokens) or None if no input tokens were reported
+    """
+    if "in" not in usage:
+        return None
+    tokens_out = usage.get("out")
+    if tokens_out is None:
+        try: tokens_out = len(get_encoding(spec.tokenizer).encode(text))
+        except Exception: tokens_out = len(text) // 4
+    return usage["in"], tokens_out, usage.get("cached", 0)
+
+
+def _stream_until(spec, prompt, system_prompt, api_key, temp=None, stop_when=None, static_prefix=""):
+    """
+    Stream a completion, cancelling it as soon as stop_when is true for the text received so far
+    @param stop_when: (callable) predicate on the text received so far
+    @return: (tuple) (text received, provider-reported usage or None)
+    """
+    text = str()
+    usage = dict()
+    chunks = _stream_chunks(spec, prompt, system_prompt, api_key, temp, static_prefix, usage)
+    try:
+        for chunk in chunks:
+            text += chunk
+            if stop_when is not None and stop_when(text):
+                # an answer which ends here is followed right away by its usage, so wait for one more chunk
+                next(chunks, None)
+                break
+    finally:
+        chunks.close()
+    return text, _streamed_usage(spec, usage, text)
+
+
+def _send(spec, prompt, system_prompt, api_key, temp=None, version="1.5", static_prefix="", stop_when=None, n=1):
+    """
+    Send one request, streamed and cancelled once stop_when is true when a predicate is given
+    @param n: (int) number of samples, only for models with supports_n (not streamed)
+    @return: (tuple) (answer, or list of n answers when n > 1, provider-reported usage or None)
+    """
+    if stop_when is not None and n == 1:
+        return _stream_until(spec, prompt, system_prompt, api_key, temp=temp, stop_when=stop_when, static_prefix=static_prefix)
+    response = _complete(spec, prompt, system_prompt, api_key, temp=temp, version=version, static_prefix=static_prefix, n=n)
+    if n > 1:
+        return [choice.message.content for choice in response.choices], _reported_usage(spec, response)
+    return _response_text(spec, response), _reported_usage(spec, response)
+
+
+def _hedged_send(spec, prompt, system_prompt, api_keys, temp=None, version="1.5", static_prefix="", stop_when=None, n=1):
+    """
+    Send a request and, if it is slower than the model's HEDGE_QUANTILE latency, a duplicate to the model's
+    first fallback (or the model itself). The first answer wins, the other request is cancelled by closing its
+    stream; models without streaming run to completion and the losing answer is only accounted for.
+    @param api_keys: (tuple) (openai_api_key, gemini_api_key, anthropic_api_key)
+    @return: (tuple) (answer, provider-reported usage or None, spec of the model which answered)
+    """
+    delay = LATENCY.quantile(spec.name, HEDGE_QUANTILE) if HEDGE_REQUESTS else None
+    if delay is None:
+        start = time.time()
+        answer, usage = _send(spec, prompt, system_prompt, _provider_api_key(spec, *api_keys), temp, version, static_prefix, stop_when, n)
+        LATENCY.record(spec.name, time.time() - start)
+        return answer, usage, spec
+    fallbacks = FALLBACK_MODELS.get(spec.name)
+    hedge_spec = resolve_model(fallbacks[0]) if fallbacks else spec
+    if n > 1 and not hedge_spec.supports_n: hedge_spec = spec
+    cancelled = threading.Event()
+    claim_lock = threading.Lock()
+
+    def run(run_spec, hedge):
+        if hedge:
+            time.sleep(RATE_LIMITER.reserve(run_spec, _estimate_tokens(run_spec, prompt, static_prefix + system_prompt, n)))
+        predicate = stop_when
+        if run_spec.supports_streaming and version != "0.28" and n == 1:
+            # streamed so the losing request can be cancelled
+            predicate = lambda text: cancelled.is_set() or (stop_when is not None and stop_when(text))
+        start = time.time()
+        answer, usage = _send(run_spec, prompt, system_prompt, _provider_api_key(run_spec, *api_keys), temp, version, static_prefix, predicate, n)
+        with claim_lock:
+            won = not cancelled.is_set()
+            cancelled.set()
+        # the primary's latency is recorded whether it won or not (a cancelled primary gives a lower bound),
+        # so the quantile is not cut off at the hedge delay; a hedge on the same model is never recorded
+        if not hedge or run_spec is not spec:
+            LATENCY.record(run_spec.name, time.time() - start)
+        if not won:
+            _record_usage(run_spec, prompt, static_prefix + system_prompt, "".join(answer), usage, print_cost=False)
+            return None
+        return answer, usage, run_spec
+
+    executor = _hedge_executor()
+    pending = {executor.submit(contextvars.copy_context().run, run, spec, False)}
+    done, _ = wait(pending, timeout=max(delay, HEDGE_MIN_DELAY))
+    if not done:
+        print(f"Hedging request to {spec.name} with {hedge_spec.name}")
+        pending.add(executor.submit(contextvars.copy_context().run, run, hedge_spec, True))
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            if result is not None:
+                return result
+    raise error
+
+
+def _model_semaphore(spec):
+    """
+    Per-model semaphore on the running event loop, bounding in-flight async requests
+    @param spec: (ModelSpec) model spec
+    @return: (asyncio.Semaphore) semaphore
+    """
+    loop_semaphores = _ASYNC_SEMAPHORES.setdefault(asyncio.get_running_loop(), dict())
+    if spec.name not in loop_semaphores:
+        loop_semaphores[spec.name] = asyncio.Semaphore(spec.max_concurrency)
+    return loop_semaphores[spec.name]
+
+
+def _resolve_keys(openai_api_key=None, gemini_api_key=None, anthropic_api_key=None):
     preloaded_api = os.getenv('OPENAI_API_KEY')
     if openai_api_key is None and preloaded_api is not None:
         openai_api_key = preloaded_api
@@ -45,170 +1114,181 @@ def query_model(model_str, prompt, system_prompt, openai_api_key=None, gemini_ap
         os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
     if gemini_api_key is not None:
         os.environ["GEMINI_API_KEY"] = gemini_api_key
-    for _ in range(tries):
+    return openai_api_key
+
+
+def _reported_usage(spec, response):
+    """
+    Token usage reported by the provider, if present
+    @return: (tuple) (input tokens, output tokens, cached input tokens) or None
+    """
+    try:
+        if spec.provider == "anthropic":
+            usage = response.usage
+            # input_tokens excludes the prompt prefix read from or written to the cache
+            cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+            cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+            return usage.input_tokens + cache_read + cache_write, usage.output_tokens, cache_read
+        elif spec.provider == "gemini":
+            usage = response.usage_metadata
+            return usage.prompt_token_count, usage.candidates_token_count, 0
+        usage = response.usage
+        if usage is None: return None
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        return usage.prompt_tokens, usage.completion_tokens, cached
+    except Exception:
+        return None
+
+
+def _estimate_tokens(spec, prompt, system_prompt, n=1):
+    """
+    Tokens to reserve with the rate limiter for a request of n samples, 0 when the model has no token limit.
+    A rough count (~4 characters per token), settle() corrects the reservation with the real usage.
+    """
+    if not spec.tpm:
+        return 0
+    return (len(system_prompt) + len(prompt)) // 4 + n * (spec.max_tokens or RATE_LIMIT_OUTPUT_ESTIMATE)
+
+
+def _record_usage(spec, prompt, system_prompt, answer, usage=None, print_cost=True):
+    """
+    Add the usage of a request to the ledger
+    @param usage: (tuple) provider-reported (input tokens, output tokens, cached input tokens),
+        counted from the prompt and answer when None
+    @return: (tuple) (input tokens, output tokens, cached input tokens) or None on error
+    """
+    try:
+        reported = usage is not None
+        if usage is None:
+            encoding = get_encoding(spec.tokenizer)
+            usage = (len(encoding.encode(system_prompt + prompt)), len(encoding.encode(answer)), 0)
+        USAGE.add(_USAGE_LAB.get(), _USAGE_PHASE.get(), spec.name, *usage, reported=reported)
+        if print_cost:
+            print(f"Current experiment cost = ${curr_cost_est()}, prompt cache hit rate = {USAGE.cache_hit_rate():.1%} "
+                  f"(of provider-reported input tokens), ** Approximate values, may not reflect true cost")
+    except Exception as e:
+        if print_cost: print(f"Cost approximation has an error? {e}")
+    return usage
+
+
+def query_model(model_str, prompt, system_prompt, openai_api_key=None, gemini_api_key=None,  anthropic_api_key=None, tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5", use_cache=True, stop_when=None, static_prefix="", n=1):
+    """
+    Query a language model, retrying rate limits, overloads and timeouts with jittered exponential backoff
+    (honouring Retry-After). Bad requests are raised immediately.
+    Requests wait for budget from RATE_LIMITER when the model has rpm / tpm limits.
+    @param timeout: (float) base backoff delay in seconds
+    @param stop_when: (callable) predicate on the text received so far, e.g. command_block_closed;
+        the answer is streamed and the request cancelled once it is true (models without streaming answer in full)
+    @param static_prefix: (str) content sent before the system prompt which is byte-identical across requests
+        (role, command docs, ...), so providers can serve it from their prompt cache; keep anything that
+        changes between steps in system_prompt or prompt, or the cached prefix ends there
+    @param n: (int) number of samples; one request for models with supports_n (not streamed), otherwise
+        n concurrent requests. Samples bypass the response cache. Drawing a step's candidates this way sends
+        the shared prompt once, instead of once per candidate.
+    With configure_hedging, a request slower than the model's p95 latency is duplicated to a fallback model.
+    @return: (str) model answer, (list) of n answers when n > 1
+    """
+    openai_api_key = _resolve_keys(openai_api_key, gemini_api_key, anthropic_api_key)
+    spec = resolve_model(model_str)
+    api_keys = (openai_api_key, gemini_api_key, anthropic_api_key)
+    if n > 1 and (not spec.supports_n or version == "0.28"):
+        with ThreadPoolExecutor(max_workers=min(n, spec.max_concurrency)) as executor:
+            samples = [executor.submit(contextvars.copy_context().run, query_model, model_str, prompt, system_prompt,
+                                       openai_api_key, gemini_api_key, anthropic_api_key, tries, timeout, temp, print_cost,
+                                       version, False, stop_when, static_prefix) for _ in range(n)]
+            return [sample.result() for sample in samples]
+    if not spec.supports_streaming or version == "0.28" or n > 1: stop_when = None
+    cache_key = _response_cache_key(spec, prompt, static_prefix + system_prompt, temp, use_cache and n == 1, stop_when)
+    if cache_key is not None:
+        answer = RESPONSE_CACHE.get(cache_key)
+        if answer is not None: return answer
+    policy = RetryPolicy(base_delay=timeout, max_delay=RETRY_POLICY.max_delay)
+    breaker = get_circuit_breaker(spec.provider)
+    est_tokens = _estimate_tokens(spec, prompt, static_prefix + system_prompt, n)
+    for _attempt in range(tries):
+        time.sleep(max(breaker.wait_time(), RATE_LIMITER.reserve(spec, est_tokens)))
         try:
-            if model_str == "gpt-4o-mini" or model_str == "gpt4omini" or model_str == "gpt-4omini" or model_str == "gpt4o-mini":
-                model_str = "gpt-4o-mini"
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}]
-                if version == "0.28":
-                    if temp is None:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages
-                        )
-                    else:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages, temperature=temp
-                        )
-                else:
-                    client = OpenAI()
-                    if temp is None:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-mini-2024-07-18", messages=messages, )
-                    else:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-mini-2024-07-18", messages=messages, temperature=temp)
-                answer = completion.choices[0].message.content
-
-            elif model_str == "gemini-2.0-pro":
-                genai.configure(api_key=gemini_api_key)
-                model = genai.GenerativeModel(model_name="gemini-2.0-pro-exp-02-05", system_instruction=system_prompt)
-                answer = model.generate_content(prompt).text
-            elif model_str == "gemini-1.5-pro":
-                genai.configure(api_key=gemini_api_key)
-                model = genai.GenerativeModel(model_name="gemini-1.5-pro", system_instruction=system_prompt)
-                answer = model.generate_content(prompt).text
-            elif model_str == "o3-mini":
-                model_str = "o3-mini"
-                messages = [
-                    {"role": "user", "content": system_prompt + prompt}]
-                if version == "0.28":
-                    completion = openai.ChatCompletion.create(
-                        model=f"{model_str}",  messages=messages)
-                else:
-                    client = OpenAI()
-                    completion = client.chat.completions.create(
-                        model="o3-mini-2025-01-31", messages=messages)
-                answer = completion.choices[0].message.content
-
-            elif model_str == "claude-3.5-sonnet":
-                client = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-                message = client.messages.create(
-                    model="claude-3-5-sonnet-latest",
-                    system=system_prompt,
-                    messages=[{"role": "user", "content": prompt}])
-                answer = json.loads(message.to_json())["content"][0]["text"]
-            elif model_str == "gpt4o" or model_str == "gpt-4o":
-                model_str = "gpt-4o"
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}]
-                if version == "0.28":
-                    if temp is None:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages
-                        )
-                    else:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages, temperature=temp)
-                else:
-                    client = OpenAI()
-                    if temp is None:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-2024-08-06", messages=messages, )
-                    else:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-2024-08-06", messages=messages, temperature=temp)
-                answer = completion.choices[0].message.content
-            elif model_str == "deepseek-chat":
-                model_str = "deepseek-chat"
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}]
-                if version == "0.28":
-                    raise Exception("Please upgrade your OpenAI version to use DeepSeek client")
-                else:
-                    deepseek_client = OpenAI(
-                        api_key=os.getenv('DEEPSEEK_API_KEY'),
-                        base_url="https://api.deepseek.com/v1"
-                    )
-                    if temp is None:
-                        completion = deepseek_client.chat.completions.create(
-                            model="deepseek-chat",
-                            messages=messages)
-                    else:
-                        completion = deepseek_client.chat.completions.create(
-                            model="deepseek-chat",
-                            messages=messages,
-                            temperature=temp)
-                answer = completion.choices[0].message.content
-            elif model_str == "o1-mini":
-                model_str = "o1-mini"
-                messages = [
-                    {"role": "user", "content": system_prompt + prompt}]
-                if version == "0.28":
-                    completion = openai.ChatCompletion.create(
-                        model=f"{model_str}",  # engine = "deployment_name".
-                        messages=messages)
-                else:
-                    client = OpenAI()
-                    completion = client.chat.completions.create(
-                        model="o1-mini-2024-09-12", messages=messages)
-                answer = completion.choices[0].message.content
-            elif model_str == "o1":
-                model_str = "o1"
-                messages = [
-                    {"role": "user", "content": system_prompt + prompt}]
-                if version == "0.28":
-                    completion = openai.ChatCompletion.create(
-                        model="o1-2024-12-17",  # engine = "deployment_name".
-                        messages=messages)
-                else:
-                    client = OpenAI()
-                    completion = client.chat.completions.create(
-                        model="o1-2024-12-17", messages=messages)
-                answer = completion.choices[0].message.content
-            elif model_str == "o1-preview":
-                model_str = "o1-preview"
-                messages = [
-                    {"role": "user", "content": system_prompt + prompt}]
-                if version == "0.28":
-                    completion = openai.ChatCompletion.create(
-                        model=f"{model_str}",  # engine = "deployment_name".
-                        messages=messages)
-                else:
-                    client = OpenAI()
-                    completion = client.chat.completions.create(
-                        model="o1-preview", messages=messages)
-                answer = completion.choices[0].message.content
+            answer, usage, answered_spec = _hedged_send(spec, prompt, system_prompt, api_keys, temp=temp, version=version,
+                                                           static_prefix=static_prefix, stop_when=stop_when, n=n)
+            breaker.record_success()
+            usage = _record_usage(answered_spec, prompt, static_prefix + system_prompt, "".join(answer), usage, print_cost)
+            if answered_spec is not spec: return answer
+            if usage is not None: RATE_LIMITER.settle(spec, est_tokens, usage[0] + usage[1])
+            if cache_key is not None: RESPONSE_CACHE.put(cache_key, answer)
+            return answer
+        except Exception as e:
+            error_type = policy.classify(e)
+            print(f"Inference Exception ({error_type}):", e)
+            if error_type == "bad_request": raise
+            if error_type != "other": breaker.record_failure()
+            if _attempt < tries - 1: time.sleep(policy.delay(_attempt, e))
+    raise Exception("Max retries: timeout")
+
 
+def stream_model(model_str, prompt, system_prompt, openai_api_key=None, gemini_api_key=None, anthropic_api_key=None, temp=None, print_cost=True, static_prefix=""):
+    """
+    Stream the answer of a language model as it is generated, without retries.
+    Stopping the iteration early (break, or closing the generator) cancels the request.
+    Models without streaming yield their full answer from query_model at once.
+    e.g. for chunk in stream_model("gpt-4o-mini", prompt, sys): print(chunk, end="")
+    @return: generator of text chunks
+    """
+    openai_api_key = _resolve_keys(openai_api_key, gemini_api_key, anthropic_api_key)
+    spec = resolve_model(model_str)
+    if not spec.supports_streaming:
+        yield query_model(model_str, prompt, system_prompt, openai_api_key=openai_api_key, gemini_api_key=gemini_api_key,
+                          anthropic_api_key=anthropic_api_key, temp=temp, print_cost=print_cost, static_prefix=static_prefix)
+        return
+    api_key = _provider_api_key(spec, openai_api_key, gemini_api_key, anthropic_api_key)
+    est_tokens = _estimate_tokens(spec, prompt, static_prefix + system_prompt)
+    time.sleep(max(get_circuit_breaker(spec.provider).wait_time(), RATE_LIMITER.reserve(spec, est_tokens)))
+    text = str()
+    reported = dict()
+    try:
+        for chunk in _stream_chunks(spec, prompt, system_prompt, api_key, temp=temp, static_prefix=static_prefix, usage=reported):
+            text += chunk
+            yield chunk
+    finally:
+        usage = _record_usage(spec, prompt, static_prefix + system_prompt, text, _streamed_usage(spec, reported, text), print_cost)
+        if usage is not None: RATE_LIMITER.settle(spec, est_tokens, usage[0] + usage[1])
+
+
+async def aquery_model(model_str, prompt, system_prompt, openai_api_key=None, gemini_api_key=None,  anthropic_api_key=None, tries=5, timeout=5.0, temp=None, print_cost=True, use_cache=True, static_prefix=""):
+    """
+    Async version of query_model, with the same model resolution, retries and cost accounting.
+    Concurrent calls on one event loop are bounded by the model's max_concurrency.
+    e.g. answers = await asyncio.gather(*[aquery_model("gpt-4o-mini", p, sys) for p in prompts])
+    @return: (str) model answer
+    """
+    openai_api_key = _resolve_keys(openai_api_key, gemini_api_key, anthropic_api_key)
+    spec = resolve_model(model_str)
+    api_key = _provider_api_key(spec, openai_api_key, gemini_api_key, anthropic_api_key)
+    cache_key = _response_cache_key(spec, prompt, static_prefix + system_prompt, temp, use_cache)
+    if cache_key is not None:
+        answer = RESPONSE_CACHE.get(cache_key)
+        if answer is not None: return answer
+    policy = RetryPolicy(base_delay=timeout, max_delay=RETRY_POLICY.max_delay)
+    breaker = get_circuit_breaker(spec.provider)
+    est_tokens = _estimate_tokens(spec, prompt, static_prefix + system_prompt)
+    async with _model_semaphore(spec):
+        for _attempt in range(tries):
+            await asyncio.sleep(max(breaker.wait_time(), RATE_LIMITER.reserve(spec, est_tokens)))
             try:
-                if model_str in ["o1-preview", "o1-mini", "claude-3.5-sonnet", "o1", "o3-mini"]:
-                    encoding = tiktoken.encoding_for_model("gpt-4o")
-                elif model_str in ["deepseek-chat"]:
-                    encoding = tiktoken.encoding_for_model("cl100k_base")
-                else:
-                    encoding = tiktoken.encoding_for_model(model_str)
-                if model_str not in TOKENS_IN:
-                    TOKENS_IN[model_str] = 0
-                    TOKENS_OUT[model_str] = 0
-                TOKENS_IN[model_str] += len(encoding.encode(system_prompt + prompt))
-                TOKENS_OUT[model_str] += len(encoding.encode(answer))
-                if print_cost:
-                    print(f"Current experiment cost = ${curr_cost_est()}, ** Approximate values, may not reflect true cost")
+                response = await _acomplete(spec, prompt, system_prompt, api_key, temp=temp, static_prefix=static_prefix)
+                breaker.record_success()
+                answer = _response_text(spec, response)
+                usage = _record_usage(spec, prompt, static_prefix + system_prompt, answer, _reported_usage(spec, response), print_cost)
+                if usage is not None: RATE_LIMITER.settle(spec, est_tokens, usage[0] + usage[1])
+                if cache_key is not None: RESPONSE_CACHE.put(cache_key, answer)
+                return answer
             except Exception as e:
-                if print_cost: print(f"Cost approximation has an error? {e}")
-            return answer
-        except Exception as e:
-            print("Inference Exception:", e)
-            time.sleep(timeout)
-            continue
+                error_type = policy.classify(e)
+                print(f"Inference Exception ({error_type}):", e)
+                if error_type == "bad_request": raise
+                if error_type != "other": breaker.record_failure()
+                if _attempt < tries - 1: await asyncio.sleep(policy.delay(_attempt, e))
     raise Exception("Max retries: timeout")
 
 
-#print(query_model(model_str="o1-mini", prompt="hi", system_prompt="hey"))
\ No newline at end of file
+#print(query_model(model_str="o1-mini", prompt="hi", system_prompt="hey"))
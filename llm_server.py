@@ -0,0 +1,364 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions server.
+Answers with scripted, well-formed agent commands so the whole LaboratoryWorkflow
+(orchestration, code execution, latex) can be load tested without paid api calls.
+
+python llm_server.py --port 8765 --latency lognormal:0.0,0.5
+then use the "local-stub" model (e.g. llm-backend: "local-stub") with any api key.
+"""
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+ARXIV_IDS = ["1706.03762", "1810.04805", "2005.14165", "2201.11903", "2203.11171",
+             "2210.03629", "2305.10601", "2303.17651", "2302.04761", "2309.03409"]
+
+EXPERIMENT_CODE = (
+    "import numpy as np\n"
+    "rng = np.random.default_rng(0)\n"
+    "X = rng.normal(size=(500, 8))\n"
+    "w = rng.normal(size=8)\n"
+    "y = (X @ w > 0).astype(int)\n"
+    "pred = (X @ (w + rng.normal(scale=0.5, size=8)) > 0).astype(int)\n"
+    "print('This experiment measures the accuracy of a noisy linear classifier on synthetic data.')\n"
+    "print(f'Accuracy: {(pred == y).mean():.3f}')"
+)
+
+DATASET_CODE = (
+    "import numpy as np\n"
+    "data = np.random.default_rng(0).normal(size=(500, 8))\n"
+    "print(f'Loaded dataset with shape {data.shape}')"
+)
+
+LATEX_SCAFFOLD = "\n".join([
+    "\\documentclass{article}",
+    "\\title{Research Report: Scripted Stand-in Results}",
+    "\\author{Agent Laboratory}",
+    "\\begin{document}",
+    "\\maketitle",
+    "\\begin{abstract}",
+    "[ABSTRACT HERE]",
+    "\\end{abstract}",
+    "\\section{Introduction}",
+    "[INTRODUCTION HERE]",
+    "\\section{Background}",
+    "[BACKGROUND HERE]",
+    "\\section{Related Work}",
+    "[RELATED WORK HERE]",
+    "\\section{Methods}",
+    "[METHODS HERE]",
+    "\\section{Experimental Setup}",
+    "[EXPERIMENTAL SETUP HERE]",
+    "\\section{Results}",
+    "[RESULTS HERE]",
+    "\\section{Discussion}",
+    "[DISCUSSION HERE]",
+    "\\end{document}",
+])
+
+SECTION_TEXT = (
+    "We study a noisy linear classifier on synthetic data and report an accuracy of 0.9 on the held out set. "
+    "The method perturbs the weight vector $w$ with Gaussian noise $\\epsilon \\sim \\mathcal{N}(0, 0.25 I)$ "
+    "and predicts $\\hat{y} = \\mathbb{1}[x^\\top (w + \\epsilon) > 0]$.\n\n"
+    "These results are produced by a scripted stand-in language model and carry no scientific meaning."
+)
+
+
+class LatencyModel:
+    def __init__(self, spec="fixed:0.0"):
+        """
+        Distribution of the delay before the first token of a response
+        @param spec: (str) "fixed:S", "uniform:LOW,HIGH" or "lognormal:MU,SIGMA" (seconds)
+        """
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(_p) for _p in params.split(",") if _p.strip()]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise Exception(f"Unknown latency distribution: {spec}")
+
+    def sample(self):
+        """
+        @return: (float) delay in seconds
+        """
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        elif self.kind == "uniform":
+            return random.uniform(self.params[0], self.params[1])
+        return random.lognormvariate(self.params[0], self.params[1])
+
+
+class ScriptedResponder:
+    def __init__(self):
+        """
+        Maps a chat request to a plausible, syntactically valid response for the agent that sent it
+        """
+        self._lock = threading.Lock()
+        self.calls = dict()
+
+    def _count(self, kind):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            return self.calls[kind]
+
+    @staticmethod
+    def _next_arxiv_id(text):
+        reviewed = re.search(r"Papers in your review so far: ([^\n]*)", text)
+        reviewed = reviewed.group(1).split() if reviewed else []
+        for arxiv_id in ARXIV_IDS:
+            if arxiv_id not in reviewed: return arxiv_id
+        return ARXIV_IDS[0]
+
+    @staticmethod
+    def _paper_edit(text):
+        """
+        Edit a line of body text of the current paper, keeping the latex valid
+        """
+        paper = text.split("Provided here is your current paper", 1)[-1]
+        for line_no, line in re.findall(r"^(\d+) \|(.*)$", paper, re.MULTILINE):
+            if line.strip() and not line.strip().startswith("\\") and not line.strip().startswith("["):
+                return f"```EDIT {line_no} {line_no}\n{line}\nWe further observe that the reported improvement is stable across random seeds.\n```"
+        return "```EDIT 0 0\n\\documentclass{article}\n```"
+
+    def respond(self, system, prompt):
+        """
+        @param system: (str) system message (empty for models with the system prompt in the user message)
+        @param prompt: (str) last user message
+        @return: (str) scripted response
+        """
+        text = system + "\n" + prompt
+        step = re.search(r"Current Step #(\d+), Phase: ([a-z ]+)", text)
+        phase = step.group(2).strip() if step else None
+        # reviewers and reward models
+        if "REVIEW JSON" in text:
+            self._count("review")
+            review = {
+                "Summary": "A scripted review.", "Strengths": ["Clear"], "Weaknesses": ["Synthetic data"],
+                "Originality": 2, "Quality": 3, "Clarity": 3, "Significance": 2, "Questions": [], "Limitations": [],
+                "Ethical Concerns": False, "Soundness": 3, "Presentation": 3, "Contribution": 2,
+                "Overall": random.randint(4, 7), "Confidence": 3, "Decision": "Reject"}
+            return f"THOUGHT:\nThe paper is coherent but limited.\n\nREVIEW JSON:\n```json\n{json.dumps(review, indent=2)}\n```"
+        if "expert reward model" in text:
+            self._count("score")
+            return f"```SCORE\n{random.uniform(0.3, 0.9):.2f}\n```"
+        if "automated code repair tool" in text:
+            self._count("repair")
+            if "CODE EDITING TOOL" in text: return "```EDIT 0 0\nimport numpy as np\n```"
+            return f"```python\n{EXPERIMENT_CODE}\n```"
+        # paper-solver
+        if "research paper finder" in text:
+            self._count("paper search")
+            return "chain of thought prompting"
+        if "only build the scaffolding for the paper" in text:
+            self._count("paper scaffold")
+            return f"```REPLACE\n{LATEX_SCAFFOLD}\n```"
+        if "Your only goal is to generate latex for the following" in text:
+            self._count("paper section")
+            return f"```REPLACE\n{SECTION_TEXT}\n```"
+        if "PAPER EDITING TOOL" in text:
+            self._count("paper edit")
+            return self._paper_edit(text)
+        # mle-solver
+        if "write code to solve machine learning research challenges" in text:
+            if "Please reflect" in prompt or "Please provide a detailed reflection" in prompt or "Reflect on" in prompt:
+                self._count("code reflection")
+                return "Increase the number of samples and reduce the noise scale in lines 5 to 6."
+            self._count("code")
+            if "CODE EDITING TOOL" in text and random.random() < 0.5:
+                return "```EDIT 5 5\npred = (X @ (w + rng.normal(scale=0.3, size=8)) > 0).astype(int)\n```"
+            return f"```REPLACE\n{EXPERIMENT_CODE}\n```"
+        # agent phases
+        if phase is not None:
+            self._count(phase)
+            turn = int(step.group(1))
+            if phase == "literature review":
+                if turn == 0 and "Papers in your review so far" not in text:
+                    return "```SUMMARY\nprompting techniques for reasoning\n```"
+                return f"```ADD_PAPER\n{self._next_arxiv_id(text)}\nA scripted summary of a relevant paper.\n```"
+            if phase == "plan formulation":
+                if "postdoctoral" in system and turn >= 1:
+                    return "```PLAN\nEvaluate a noisy linear classifier on synthetic data and report its accuracy.\n```"
+                return "```DIALOGUE\nLet us start from a simple baseline on synthetic data.\n```"
+            if phase == "data preparation":
+                if "software engineer" in system and turn >= 1:
+                    return f"```SUBMIT_CODE\n{DATASET_CODE}\n```"
+                return "```DIALOGUE\nThe synthetic dataset is ready to be loaded with numpy.\n```"
+            if phase == "results interpretation":
+                if "postdoctoral" in system and turn >= 1:
+                    return "```INTERPRETATION\nThe classifier reaches an accuracy of 0.9, noise lowers it gracefully.\n```"
+                return "```DIALOGUE\nThe accuracy is high given the injected noise.\n```"
+            if phase == "report refinement":
+                return "n"
+            return "```DIALOGUE\nUnderstood.\n```"
+        self._count("other")
+        return "This is a scripted response from the local stand-in language model."
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, responder, latency, tokens_per_second=200.0, error_rate=0.0):
+        """
+        Chat completions server answering with a ScriptedResponder
+        @param address: (tuple) (host, port)
+        @param responder: (ScriptedResponder) produces the response text
+        @param latency: (LatencyModel) delay before the first token
+        @param tokens_per_second: (float) generation speed after the first token
+        @param error_rate: (float) fraction of requests answered with a 429 rate limit error
+        """
+        super().__init__(address, StubRequestHandler)
+        self.responder = responder
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.seen_prefixes = set()
+        self.stats = {"requests": 0, "errors": 0, "streamed": 0}
+        self.stats_lock = threading.Lock()
+
+    def record(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def cached_tokens(self, system):
+        """
+        Emulate provider prompt caching: a system prompt seen before counts as cached input
+        """
+        if len(system) < 1024: return 0
+        key = hashlib.sha256(system.encode("utf-8")).hexdigest()
+        with self.stats_lock:
+            if key in self.seen_prefixes: return count_tokens(system)
+            self.seen_prefixes.add(key)
+        return 0
+
+
+def count_tokens(text):
+    # rough estimate, good enough for load testing
+    return max(1, math.ceil(len(text) / 4))
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for _name, _value in (headers or dict()).items():
+            self.send_header(_name, _value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "agentlab-stub", "object": "model", "owned_by": "agentlab"}]})
+        elif self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, {**self.server.stats, "calls": self.server.responder.calls})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        self.server.record("requests")
+        if random.random() < self.server.error_rate:
+            self.server.record("errors")
+            self._send_json(429, {"error": {"message": "Rate limit reached (scripted)", "type": "rate_limit_error"}}, {"Retry-After": "1"})
+            return
+        messages = body.get("messages", [])
+        system = "\n".join(str(_m.get("content", "")) for _m in messages if _m.get("role") == "system")
+        prompt = str(messages[-1].get("content", "")) if messages else ""
+        answers = [self.server.responder.respond(system, prompt) for _ in range(int(body.get("n", 1)))]
+        usage = {
+            "prompt_tokens": count_tokens(system + prompt),
+            "completion_tokens": sum(count_tokens(_a) for _a in answers),
+            "prompt_tokens_details": {"cached_tokens": self.server.cached_tokens(system)}}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        time.sleep(self.server.latency.sample())
+        if body.get("stream"):
+            self.server.record("streamed")
+            self._stream(body, answers, usage)
+            return
+        self._send_json(200, {
+            "id": f"chatcmpl-stub-{random.getrandbits(32):08x}", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "agentlab-stub"),
+            "choices": [{"index": _i, "message": {"role": "assistant", "content": _a}, "finish_reason": "stop"}
+                        for _i, _a in enumerate(answers)],
+            "usage": usage})
+
+    def _stream(self, body, answers, usage):
+        """
+        Server-sent events, one chunk per word; the client closing the connection stops generation
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-stub-{random.getrandbits(32):08x}"
+        interval = 1.0 / self.server.tokens_per_second if self.server.tokens_per_second > 0 else 0.0
+
+        def event(choices, **extra):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "agentlab-stub"), "choices": choices, **extra}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        try:
+            for _i, _answer in enumerate(answers):
+                for _piece in re.findall(r"\S*\s*", _answer):
+                    if not _piece: continue
+                    event([{"index": _i, "delta": {"content": _piece}, "finish_reason": None}])
+                    if interval: time.sleep(interval * count_tokens(_piece))
+                event([{"index": _i, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or dict()).get("include_usage"):
+                event([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+def start_server(host="127.0.0.1", port=8765, latency="fixed:0.0", tokens_per_second=200.0, error_rate=0.0):
+    """
+    Start the stand-in server on a background thread, e.g. from a load test script
+    @return: (StubServer) server, stop it with server.shutdown()
+    """
+    server = StubServer((host, port), ScriptedResponder(), LatencyModel(latency), tokens_per_second, error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Local stand-in LLM server for offline Agent Laboratory load tests")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Interface to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+    parser.add_argument(
+        '--latency',
+        type=str,
+        default="fixed:0.0",
+        help='Delay before the first token: fixed:S, uniform:LOW,HIGH or lognormal:MU,SIGMA (seconds).'
+    )
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help='Generation speed, 0 for instant.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 429.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    server = StubServer((args.host, args.port), ScriptedResponder(), LatencyModel(args.latency), args.tokens_per_second, args.error_rate)
+    print(f"Stand-in LLM server listening on http://{args.host}:{args.port}/v1 (latency {args.latency})")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server_close()
@@ -263,8 +263,9 @@ class MLESolver:
             model_resp = query_model(
                 openai_api_key=self.openai_api_key,
                 model_str=self.model,
-                system_prompt=self.system_prompt(),
-                prompt=f"{err_hist}\nYou should now use ```REPLACE to create initial code to solve the challenge. Now please enter the ```REPLACE command below:\n ", temp=1.0)
+                static_prefix=self.static_prompt(),
+                system_prompt=self.code_reflect,
+                prompt=f"{err_hist}\nYou should now use ```REPLACE to create initial code to solve the challenge. Now please enter the ```REPLACE command below:\n ", temp=1.0, stop_when=command_block_closed)
             model_resp = self.clean_text(model_resp)
             cmd_str, code_lines, prev_code_ret, should_execute_code, score = self.process_command(model_resp)
             if not self.supress_print: print(f"@@@ INIT ATTEMPT: Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
@@ -282,27 +283,32 @@ class MLESolver:
         while True:
             if len(self.commands) == 2: cmd_app_str = "You must output either the ```EDIT or ```REPLACE command immediately. "
             else: cmd_app_str = ""
-            model_resp = query_model(
+            # all candidates of this step in one request
+            model_resps = query_model(
                 openai_api_key=self.openai_api_key,
                 model_str=self.model,
-                system_prompt=self.system_prompt(),
-                prompt=f"The following is your history:{self.history_str()}\n\n{cmd_app_str}Now please enter a command: ", temp=1.0)
-            model_resp = self.clean_text(model_resp)
-            self.code_lines = copy(random.choice(self.best_codes)[0])
-            cmd_str, code_lines, prev_code_ret, should_execute_code, score = self.process_command(model_resp)
-            self.st_history.append([model_resp, prev_code_ret, code_lines, cmd_str])
-            if len(self.st_history) > self.st_hist_len: self.st_history.pop(0)
-            if score is not None:
-                if top_score is None:
-                    best_pkg = copy(code_lines), copy(prev_code_ret), copy(should_execute_code), copy(model_resp), copy(cmd_str)
-                    top_score = score
-                elif score > top_score:
-                    best_pkg = copy(code_lines), copy(prev_code_ret), copy(should_execute_code), copy(model_resp), copy(cmd_str)
-                    top_score = score
-            if not self.supress_print: print(f"@@@ Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
-            if not self.supress_print: print(f"$$$ Score: {score}")
-            if num_attempts >= self.min_gen_trials and top_score is not None: break
-            num_attempts += 1
+                static_prefix=self.static_prompt(),
+                system_prompt=self.code_reflect,
+                prompt=f"The following is your history:{self.history_str()}\n\n{cmd_app_str}Now please enter a command: ", temp=1.0, stop_when=command_block_closed,
+                n=self.min_gen_trials + 1)
+            if type(model_resps) == str: model_resps = [model_resps]
+            for model_resp in model_resps:
+                model_resp = self.clean_text(model_resp)
+                self.code_lines = copy(random.choice(self.best_codes)[0])
+                cmd_str, code_lines, prev_code_ret, should_execute_code, score = self.process_command(model_resp)
+                self.st_history.append([model_resp, prev_code_ret, code_lines, cmd_str])
+                if len(self.st_history) > self.st_hist_len: self.st_history.pop(0)
+                if score is not None:
+                    if top_score is None:
+                        best_pkg = copy(code_lines), copy(prev_code_ret), copy(should_execute_code), copy(model_resp), copy(cmd_str)
+                        top_score = score
+                    elif score > top_score:
+                        best_pkg = copy(code_lines), copy(prev_code_ret), copy(should_execute_code), copy(model_resp), copy(cmd_str)
+                        top_score = score
+                if not self.supress_print: print(f"@@@ Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
+                if not self.supress_print: print(f"$$$ Score: {score}")
+                num_attempts += 1
+            if top_score is not None: break
         self.code_lines, self.prev_code_ret, self.should_execute_code, model_resp, cmd_str = best_pkg
         if not self.supress_print: print(prev_code_ret)
         # add top scoring code that was successful to the best codes
@@ -323,8 +329,8 @@ class MLESolver:
         """
         code_strs = ("$"*40 + "\n\n").join([self.generate_code_lines(_code[0]) + f"\nCode Return {_code[1]}" for _code in self.best_codes])
         code_strs = f"Please reflect on the following sets of code: {code_strs} and come up with generalizable insights that will help you improve your performance on this benchmark."
-        syst = self.system_prompt(commands=False) + code_strs
-        return query_model(prompt="Please reflect on ideas for how to improve your current code. Examine the provided code and think very specifically (with precise ideas) on how to improve performance, which methods to use, how to improve generalization on the test set with line-by-line examples below:\n", system_prompt=syst, model_str=f"{self.llm_str}", openai_api_key=self.openai_api_key)
+        syst = self.code_reflect + code_strs
+        return query_model(prompt="Please reflect on ideas for how to improve your current code. Examine the provided code and think very specifically (with precise ideas) on how to improve performance, which methods to use, how to improve generalization on the test set with line-by-line examples below:\n", static_prefix=self.static_prompt(commands=False), system_prompt=syst, model_str=f"{self.llm_str}", openai_api_key=self.openai_api_key)
 
     def process_command(self, model_resp):
         """
@@ -425,6 +431,14 @@ class MLESolver:
         @param commands: (bool) whether to use command prompt
         @return: (str) system prompt
         """
+        return self.static_prompt(commands) + self.code_reflect
+
+    def static_prompt(self, commands=True):
+        """
+        Part of the mle-solver system prompt which is the same at every step
+        @param commands: (bool) whether to use command prompt
+        @return: (str) static system prompt
+        """
         return (
             # ROLE DESCRIPTION
             f"{self.role_description()}.\n"
@@ -432,8 +446,6 @@ class MLESolver:
             f"The following are your task instructions: {self.phase_prompt()}\n"
             # LIT REVIEW INSIGHTS
             f"Provided below are some insights from a literature review summary:\n{self.insights}\n"
-            # CODE INSIGHTS
-            f"{self.code_reflect}"
             # NOTES
             f"The following are notes, instructions, and general tips for you: {self.notes}"
             # PLAN DESCRIPTION
@@ -447,7 +459,7 @@ class MLESolver:
             f"Your goal is to solve the research plan as well as possible. You will receive a score after you write the code and should aim to maximize the score by following the plan instructions and writing high quality code.\n"
             f"Before each experiment please include a print statement explaining exactly what the results are meant to show in great detail before printing the results out.\n"
             # COMMAND SET
-            f"The following are commands you have access to: {self.command_descriptions()}\n. You should try to have a diversity of command responses if appropriate. Do not repeat the same commend too many times. Please consider looking through your history and not repeating commands too many times." if commands else ""
+            f"The following are commands you have access to: {self.command_descriptions()}\n. You should try to have a diversity of command responses if appropriate. Do not repeat the same commend too many times. Please consider looking through your history and not repeating commands too many times.\n" if commands else ""
         )
 
     def generate_code_lines(self, code):
@@ -498,7 +510,7 @@ class MLESolver:
         @param code_str: (str) code string
         @return: (str) reflection string
         """
-        refl = query_model(prompt=reflect_prompt, system_prompt=self.system_prompt(commands=False), model_str=f"{self.llm_str}", openai_api_key=self.openai_api_key)
+        refl = query_model(prompt=reflect_prompt, static_prefix=self.static_prompt(commands=False), system_prompt=self.code_reflect, model_str=f"{self.llm_str}", openai_api_key=self.openai_api_key)
         return f"During the previous execution, the following code was run: \n\n{code_str}\n\nThis code returned the following: \n{code_return}\nThe following is your reflection from this feedback {refl}\n"
 
     def generate_dataset_descr_prompt(self):
@@ -518,7 +530,7 @@ class MLESolver:
             "You are an ML engineer and you will be writing the code for a research project.\n"
             "Your goal is to produce code that obtains final results for a set of research experiments. You should aim for simple code to collect all results, not complex code. You should integrate the provided literature review and the plan to make sure you are implementing everything outlined in the plan. The dataset code will be added to the beginning of your code always, so this does not need to be rewritten. Make sure you do not write functions, only loose code.\n"
             "I would recommend writing smaller code so you do not run out of time but make sure to work on all points in the plan in the same code. You code should run every experiment outlined in the plan for a single code.\n",
-            "You cannot pip install new libraries, but many machine learning libraries already work. If you wish to use a language model in your code, please use the following:\nAnything you decide to print inside your code will be provided to you as input, and you will be able to see that part of the code. Using print statements is useful for figuring out what is wrong and understanding your code better."
+            "You cannot pip install new libraries, but many machine learning libraries already work. If you wish to use a language model in your code, please use the following: query_gpt4omini(prompt=prompt, system=system_prompt) for a single prompt, and answers = batch_query(prompts, system=system_prompt, model=\"gpt-4o-mini\", max_concurrency=16) for a list of prompts (e.g. every question of a dataset), which runs the requests concurrently and returns the answers in the same order as prompts. Always use batch_query rather than a loop over query_gpt4omini, otherwise your code will run out of time.\nAnything you decide to print inside your code will be provided to you as input, and you will be able to see that part of the code. Using print statements is useful for figuring out what is wrong and understanding your code better."
         )
         return phase_str
 
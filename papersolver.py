@@ -265,6 +265,13 @@ class PaperSolver:
         self.prev_paper_ret = str()
         self.section_related_work = {}
         self.openai_api_key = openai_api_key
+        # reference papers are chunked, prompts only carry the parts relevant to the plan and the current section
+        self.ref_chunks = PaperChunkIndex()
+        for _i, _paper in enumerate(self.ref_papers):
+            self.ref_chunks.add_paper(f"reference paper {_i + 1}", _paper)
+        ref_results = self.ref_chunks.search(f"{self.topic}\n{self.plan}", k=4)
+        self.ref_excerpts = self.ref_chunks.format_excerpts(ref_results)
+        self.ref_excerpt_ids = [result[0] for result in ref_results]
 
     def solve(self):
         num_attempts = 0
@@ -273,25 +280,31 @@ class PaperSolver:
         self.prev_paper_ret = None
         while True:
             self.paper_lines = copy(random.choice(self.best_report)[0])
-            model_resp = query_model(
+            # candidates for this step
+            model_resps = query_model(
                 model_str=self.model,
-                system_prompt=self.system_prompt(),
+                static_prefix=self.static_prompt(),
+                system_prompt=self.step_prompt(),
                 prompt=f"\nNow please enter a command: ",
                 temp=1.0,
-                openai_api_key=self.openai_api_key)
-            model_resp = self.clean_text(model_resp)
-            cmd_str, paper_lines, prev_paper_ret, score = self.process_command(model_resp)
-            if score is not None:
-                if top_score is None:
-                    best_pkg = copy(paper_lines), copy(prev_paper_ret), copy(model_resp), copy(cmd_str)
-                    top_score = score
-                elif score > top_score:
-                    best_pkg = copy(paper_lines), copy(prev_paper_ret), copy(model_resp), copy(cmd_str)
-                    top_score = score
-            if num_attempts >= self.min_gen_trials and top_score is not None: break
-            if not self.supress_print: print(f"@@@ Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
-            if not self.supress_print: print(f"$$$ Score: {score}")
-            num_attempts += 1
+                openai_api_key=self.openai_api_key,
+                stop_when=command_block_closed,
+                n=self.min_gen_trials + 1)
+            if type(model_resps) == str: model_resps = [model_resps]
+            for model_resp in model_resps:
+                model_resp = self.clean_text(model_resp)
+                cmd_str, paper_lines, prev_paper_ret, score = self.process_command(model_resp)
+                if score is not None:
+                    if top_score is None:
+                        best_pkg = copy(paper_lines), copy(prev_paper_ret), copy(model_resp), copy(cmd_str)
+                        top_score = score
+                    elif score > top_score:
+                        best_pkg = copy(paper_lines), copy(prev_paper_ret), copy(model_resp), copy(cmd_str)
+                        top_score = score
+                if not self.supress_print: print(f"@@@ Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
+                if not self.supress_print: print(f"$$$ Score: {score}")
+                num_attempts += 1
+            if top_score is not None: break
         self.paper_lines, self.prev_paper_ret, model_resp, cmd_str = best_pkg
         # add top scoring paper that was successful to the best papers
         if top_score > self.best_report[-1][1]:
@@ -364,7 +377,8 @@ class PaperSolver:
                     prompt = f"{err}\n{rp}\nNow please enter the ```REPLACE command to create the designated section, make sure to only write the text for that section and nothing else. Do not include packages or section titles, just the section content:\n "
                 model_resp = query_model(
                     model_str=self.model,
-                    system_prompt=self.system_prompt(section=_section),
+                    static_prefix=self.static_prompt(),
+                    system_prompt=self.step_prompt(section=_section),
                     prompt=f"{prompt}",
                     temp=0.8,
                     openai_api_key=self.openai_api_key)
@@ -484,6 +498,49 @@ class PaperSolver:
         @param commands: (bool) whether to use command prompt
         @return: (str) system prompt
         """
+        return self.static_prompt(commands) + self.step_prompt(section)
+
+    def static_prompt(self, commands=True):
+        """
+        Part of the paper-solver system prompt which is the same at every step
+        @param commands: (bool) whether to use command prompt
+        @return: (str) static system prompt
+        """
+        cmd_set = f"The following are commands you have access to: {self.command_descriptions()}\n." if commands else ""
+        if len(self.ref_excerpts) == 0: ref_papers = ""
+        else: ref_papers = f"Here are excerpts of a reference paper that is high quality:\n{self.ref_excerpts}\n\n\n"
+        lit_review_str = str(self.lit_review)[:20000]
+        return (
+            f"{ref_papers}"
+            # ROLE DESCRIPTION
+            f"{self.role_description()}.\n"
+            # TASK INSTRUCTIONS
+            f"The following are your task instructions: {self.phase_prompt()}\n"
+            # NOTES
+            f"The following are notes, instructions, and general tips for you: {self.notes}"
+            # LIT REVIEW
+            f"The following literature review was provided for the paper:\n{lit_review_str}\n"
+            # PLAN DESCRIPTION
+            f"You are given a paper report writing task. The original research plan was described as follows: {self.plan}\n"
+            # EXPERIMENT CODE
+            f"A team of research wrote the following code, following this plan: {self.exp_code}\n"
+            # EXPERIMENT RESULTS
+            f"After running this code, the following results were observed: {self.exp_results}\n Your results must ACCURATELY reflect the numbers presented here."
+            # EXPERIMENT RESULT INSIGHTS
+            f"Provided was an interpretation of the experimental results:\n{self.insights}\n"
+            f"Your writing style should be boring and objective.\n"
+            # transition
+            f"Your goal is to write a research paper as well as possible. You will receive a score after you write the paper and should aim to maximize the score by writing a high quality research paper. The paper length should be 8 pages or 4000 words in total. It should be quite long and comprehensive. Remember, the paper MUST BE LONG.\n"
+            # COMMAND SET
+            f"{cmd_set}\n"
+        )
+
+    def step_prompt(self, section=None):
+        """
+        Part of the system prompt which changes between steps: paper progress, current paper and section instructions
+        @param section: (str) section to write, "scaffold" for the paper scaffold, None when editing
+        @return: (str) step system prompt
+        """
         if section == "abstract": length = "This section should be ONLY 1 paragraph."
         else: length = "This section should be approximately 2-4 paragraphs and so your output should be several paragraphs of latex."
         methods_str = str()
@@ -509,40 +566,18 @@ class PaperSolver:
         if section is not None and section == "scaffold": section_cmd = f"Your objective right now is to only build the scaffolding for the paper. You should not include any text in the body of the paper, but should have an empty scaffold for each of the sections.  Where the sections go, write [ABSTRACT HERE] for abstract, and write [INTRODUCTION HERE] for the introduction... etc. Your paper should have the following sections: 1. Abstract 2. Introduction, 3. Background, 4. Related Work 5. Methods, 6. Experimental Setup 7. Results, and 8. Discussion. Just create the scaffolding as compilable latex. Your title should start with Research Report: [title here] where title here is a title you choose. For author write Agent Laboratory."
         elif section is not None: section_cmd = f"Your only goal is to generate latex for the following {section}. DO NOT INCLUDE ANY PACKAGES OR ANY SECTION COMMANDS. DO NOT INCLUDE A TITLE OR DATE ONLY TEXT. You only have to generate text for this specific section and do not have to output anything else. {length} I repeat DO NOT INCLUDE ANY PACKAGES OR ANY SECTION COMMANDS. DO NOT INCLUDE A TITLE OR DATE ONLY TEXT. Use as many equations as you find necessary. You should include mathematical equations, numbers, and tables where necessary. Remember that to include a percentage sign % you must add a backslash \% or else it will become a comment. Here are some tips {per_section_tips[section]}  {methods_str}.\n\n"
         else: section_cmd = ""
+        ref_str = str()
+        if section is not None and section != "scaffold":
+            section_refs = self.ref_chunks.excerpts(f"{section} {per_section_tips.get(section, '')}", k=2, exclude=self.ref_excerpt_ids)
+            if len(section_refs) > 0: ref_str = f"Here are excerpts of the reference paper related to the {section}:\n{section_refs}\n\n"
         paper_len = sum([i.strip(string.punctuation).isalpha() for i in ("".join(self.paper_lines)).split()])
         #paper_len2 = len(("".join(self.paper_lines)).split())
         if paper_len < 4000: paper_progress = f"The current length of the paper is {paper_len} words, you must increase this by {4000-paper_len} words."
         else: paper_progress = ""
         if not self.supress_print: print(paper_progress)
-        cmd_set = f"The following are commands you have access to: {self.command_descriptions()}\n." if commands else ""
-        if len(self.ref_papers) == 0: ref_papers = ""
-        else:
-            refpapers = '\n'.join(self.ref_papers)
-            ref_papers = f"Here is a reference paper that is high quality:\n{refpapers}\n\n\n"
-        lit_review_str = str(self.lit_review)[:20000]
         return (
-            f"{ref_papers}"
-            # ROLE DESCRIPTION
-            f"{self.role_description()}.\n"
-            # TASK INSTRUCTIONS
-            f"The following are your task instructions: {self.phase_prompt()}\n"
-            # NOTES
-            f"The following are notes, instructions, and general tips for you: {self.notes}"
-            # LIT REVIEW
-            f"The following literature review was provided for the paper:\n{lit_review_str}\n"
-            # PLAN DESCRIPTION
-            f"You are given a paper report writing task. The original research plan was described as follows: {self.plan}\n"
-            # EXPERIMENT CODE
-            f"A team of research wrote the following code, following this plan: {self.exp_code}\n"
-            # EXPERIMENT RESULTS
-            f"After running this code, the following results were observed: {self.exp_results}\n Your results must ACCURATELY reflect the numbers presented here."
-            # EXPERIMENT RESULT INSIGHTS
-            f"Provided was an interpretation of the experimental results:\n{self.insights}\n"
-            f"Your writing style should be boring and objective.\n"
-            # transition
-            f"Your goal is to write a research paper as well as possible. You will receive a score after you write the paper and should aim to maximize the score by writing a high quality research paper. The paper length should be 8 pages or 4000 words in total. It should be quite long and comprehensive. Remember, the paper MUST BE LONG. {paper_progress}\n"
-            # COMMAND SET
-            f"{cmd_set}\n"
+            f"{ref_str}"
+            f"{paper_progress}\n"
             # PAPER
             f"Provided here is your current paper {self.generate_paper_lines(self.paper_lines)}"
             # optional section command
@@ -4,88 +4,250 @@ import os
 import time
 import arxiv
 import io, sys
+import json, shutil
+import threading
 import traceback
 import matplotlib
 import numpy as np
 import multiprocessing
 from pypdf import PdfReader
-from datasets import load_dataset
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import load_dataset, load_from_disk
 from psutil._common import bytes2human
 from datasets import load_dataset_builder
 from semanticscholar import SemanticScholar
 from sklearn.metrics.pairwise import linear_kernel
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy import sparse
+from sklearn.preprocessing import normalize
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
 
 
+# HFDataSearch indexes loaded in this process, (like_thr, dwn_thr) -> index dict
+_HF_INDEX_CACHE = dict()
+_HF_INDEX_LOCK = threading.Lock()
+# dense sentence-embedding search in HFDataSearch, off unless an embedding model is configured
+HF_EMBEDDING_MODEL = None
+HF_DENSE_WEIGHT = 0.5
+# sentence-transformers models loaded in this process, model name -> model
+_HF_EMBEDDERS = dict()
+
+
+def configure_hf_search(embedding_model="sentence-transformers/all-MiniLM-L6-v2", dense_w=0.5):
+    """
+    Rank HFDataSearch results by a mix of tf-idf and dense embedding similarity. The dense index is built
+    once per model with sentence-transformers (optional dependency) and stored next to the tf-idf index.
+    :param embedding_model: (str) sentence-transformers model name, None to use tf-idf only
+    :param dense_w: (float) share of the similarity score given to the dense embeddings, in [0, 1]
+    :return: None
+    """
+    global HF_EMBEDDING_MODEL, HF_DENSE_WEIGHT
+    HF_EMBEDDING_MODEL = embedding_model
+    HF_DENSE_WEIGHT = dense_w
+
+
+def _hf_embedder(model_name):
+    """
+    Load a sentence-transformers model once per process
+    :param model_name: (str) model name
+    :return: (SentenceTransformer) model
+    """
+    with _HF_INDEX_LOCK:
+        if model_name not in _HF_EMBEDDERS:
+            from sentence_transformers import SentenceTransformer
+            _HF_EMBEDDERS[model_name] = SentenceTransformer(model_name, device="cpu")
+        return _HF_EMBEDDERS[model_name]
+
+
+# split metadata of huggingface datasets by dataset id, shared by all labs on this machine
+HF_METADATA_CACHE = None
+_HF_METADATA_CACHE_LOCK = threading.Lock()
+
+
+def _hf_metadata_cache():
+    """
+    Cache of dataset split metadata (num_bytes, num_examples per split) by dataset id, under CACHE_DIR
+    :return: (ResponseCache) cache
+    """
+    global HF_METADATA_CACHE
+    with _HF_METADATA_CACHE_LOCK:
+        if HF_METADATA_CACHE is None:
+            HF_METADATA_CACHE = ResponseCache(os.path.join(CACHE_DIR, "hf_dataset_metadata.sqlite"))
+    return HF_METADATA_CACHE
+
 
 class HFDataSearch:
-    def __init__(self, like_thr=3, dwn_thr=50) -> None:
+    def __init__(self, like_thr=3, dwn_thr=50, embedding_model=None) -> None:
         """
         Class for finding relevant huggingface datasets
+        The filtered metadata and tf-idf index are built once into CACHE_DIR (see build_index), then memory-mapped
+        and shared by every instance in the process, so construction is fast and works offline.
         :param like_thr:
         :param dwn_thr:
+        :param embedding_model: sentence-transformers model for the dense index, defaults to HF_EMBEDDING_MODEL
         """
         self.dwn_thr = dwn_thr
         self.like_thr = like_thr
-        self.ds = load_dataset("nkasmanoff/huggingface-datasets")["train"]
-
-        # Initialize lists to collect filtered data
-        filtered_indices = []
-        filtered_descriptions = []
-        filtered_likes = []
-        filtered_downloads = []
-
-        # Iterate over the dataset and filter based on criteria
-        for idx, item in enumerate(self.ds):
-            # Get likes and downloads, handling None values
-            likes = int(item['likes']) if item['likes'] is not None else 0
-            downloads = int(item['downloads']) if item['downloads'] is not None else 0
-
-            # Check if likes and downloads meet the thresholds
-            if likes >= self.like_thr and downloads >= self.dwn_thr:
-                # Check if the description is a non-empty string
-                description = item['description']
-                if isinstance(description, str) and description.strip():
-                    # Collect the data
-                    filtered_indices.append(idx)
-                    filtered_descriptions.append(description)
-                    filtered_likes.append(likes)
-                    filtered_downloads.append(downloads)
-
-        # Check if any datasets meet all criteria
-        if not filtered_indices:
+        self.embedding_model = embedding_model if embedding_model is not None else HF_EMBEDDING_MODEL
+        self.dense_vectors = None
+        index = HFDataSearch.load_index(like_thr, dwn_thr)
+        if index is None:
             print("No datasets meet the specified criteria.")
             self.ds = []
-            self.descriptions = []
             self.likes_norm = []
             self.downloads_norm = []
             self.description_vectors = None
             return  # Exit the constructor
+        self.ds = index["ds"]
+        self.likes = index["likes"]
+        self.downloads = index["downloads"]
+        self.likes_norm = index["likes_norm"]
+        self.downloads_norm = index["downloads_norm"]
+        self.vectorizer = index["vectorizer"]
+        self.description_vectors = index["description_vectors"]
+        if self.embedding_model is not None:
+            try:
+                _hf_embedder(self.embedding_model)  # queries are embedded with the same model
+                self.dense_vectors = HFDataSearch.load_dense_index(like_thr, dwn_thr, self.embedding_model)
+            except Exception as e:
+                print(f"Dense dataset search unavailable ({e}), using tf-idf only.")
 
-        # Filter the datasets using the collected indices
-        self.ds = self.ds.select(filtered_indices)
+    @staticmethod
+    def index_path(like_thr=3, dwn_thr=50):
+        return os.path.join(CACHE_DIR, f"hf_datasets_index_v1_likes{like_thr}_downloads{dwn_thr}")
 
-        # Update descriptions, likes, and downloads
-        self.descriptions = filtered_descriptions
-        self.likes = np.array(filtered_likes)
-        self.downloads = np.array(filtered_downloads)
+    @staticmethod
+    def build_index(like_thr=3, dwn_thr=50, path=None):
+        """
+        Filter the huggingface datasets metadata and fit the tf-idf index, saved to path:
+        metadata/ (arrow, datasets.save_to_disk), vocabulary.json, and idf, likes, downloads and the
+        csr matrix (data, indices, indptr) as separate .npy files. Not a single .npz: numpy can not
+        memory-map arrays stored inside an .npz archive, it always reads them into memory.
+        :param like_thr: min likes
+        :param dwn_thr: min downloads
+        :param path: output directory, defaults to index_path(like_thr, dwn_thr)
+        :return: (bool) whether any dataset met the criteria
+        """
+        if path is None: path = HFDataSearch.index_path(like_thr, dwn_thr)
+        ds = load_dataset("nkasmanoff/huggingface-datasets")["train"]
 
-        # Normalize likes and downloads
-        self.likes_norm = self._normalize(self.likes)
-        self.downloads_norm = self._normalize(self.downloads)
+        # filter on the arrow columns, missing likes and downloads count as 0
+        table = ds.data.table
+        likes = pc.fill_null(pc.cast(table["likes"], pa.int64()), 0)
+        downloads = pc.fill_null(pc.cast(table["downloads"], pa.int64()), 0)
+        descriptions = pc.cast(table["description"], pa.string())
+        mask = pc.and_(
+            pc.and_(pc.greater_equal(likes, like_thr), pc.greater_equal(downloads, dwn_thr)),
+            pc.greater(pc.utf8_length(pc.utf8_trim_whitespace(descriptions)), 0))
+        mask = pc.fill_null(mask, False)
+        filtered_indices = np.flatnonzero(mask.to_numpy(zero_copy_only=False))
+        filtered_descriptions = pc.filter(descriptions, mask).to_pylist()
+        filtered_likes = pc.filter(likes, mask).to_numpy(zero_copy_only=False)
+        filtered_downloads = pc.filter(downloads, mask).to_numpy(zero_copy_only=False)
 
-        # Vectorize the descriptions
-        self.vectorizer = TfidfVectorizer()
-        self.description_vectors = self.vectorizer.fit_transform(self.descriptions)
+        # built in a temporary directory and renamed, so concurrent labs never see a partial index
+        tmp_path = f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        if len(filtered_indices) > 0:
+            vectorizer = TfidfVectorizer()
+            description_vectors = vectorizer.fit_transform(filtered_descriptions).tocsr()
+            ds.select(filtered_indices).save_to_disk(os.path.join(tmp_path, "metadata"))
+            with open(os.path.join(tmp_path, "vocabulary.json"), "w") as f:
+                json.dump({"vocabulary": {term: int(col) for term, col in vectorizer.vocabulary_.items()},
+                           "shape": list(description_vectors.shape)}, f)
+            np.save(os.path.join(tmp_path, "idf.npy"), vectorizer.idf_)
+            np.save(os.path.join(tmp_path, "likes.npy"), filtered_likes)
+            np.save(os.path.join(tmp_path, "downloads.npy"), filtered_downloads)
+            for name in ("data", "indices", "indptr"):
+                np.save(os.path.join(tmp_path, f"matrix_{name}.npy"), getattr(description_vectors, name))
+        try: os.replace(tmp_path, path)
+        except OSError: shutil.rmtree(tmp_path, ignore_errors=True)  # another lab finished the same build first
+        return len(filtered_indices) > 0
 
-    def _normalize(self, arr):
+    @staticmethod
+    def load_index(like_thr=3, dwn_thr=50):
+        """
+        Load the index (building it on first use), memory-mapped and cached for the process
+        :return: (dict) index components, None if no dataset meets the criteria
+        """
+        key = (like_thr, dwn_thr)
+        with _HF_INDEX_LOCK:
+            if key in _HF_INDEX_CACHE:
+                return _HF_INDEX_CACHE[key]
+            path = HFDataSearch.index_path(like_thr, dwn_thr)
+            if not os.path.exists(path):
+                HFDataSearch.build_index(like_thr, dwn_thr, path)
+            index = None
+            if os.path.exists(os.path.join(path, "vocabulary.json")):
+                with open(os.path.join(path, "vocabulary.json")) as f:
+                    meta = json.load(f)
+                vectorizer = TfidfVectorizer()
+                vectorizer.vocabulary_ = meta["vocabulary"]
+                vectorizer.idf_ = np.load(os.path.join(path, "idf.npy"))
+                matrix = [np.load(os.path.join(path, f"matrix_{name}.npy"), mmap_mode="r") for name in ("data", "indices", "indptr")]
+                likes = np.load(os.path.join(path, "likes.npy"), mmap_mode="r")
+                downloads = np.load(os.path.join(path, "downloads.npy"), mmap_mode="r")
+                index = {
+                    "ds": load_from_disk(os.path.join(path, "metadata")),
+                    "likes": likes,
+                    "downloads": downloads,
+                    "likes_norm": HFDataSearch._normalize(likes),
+                    "downloads_norm": HFDataSearch._normalize(downloads),
+                    "vectorizer": vectorizer,
+                    "description_vectors": sparse.csr_matrix(tuple(matrix), shape=tuple(meta["shape"]), copy=False),
+                }
+            _HF_INDEX_CACHE[key] = index
+            return index
+
+    @staticmethod
+    def load_dense_index(like_thr=3, dwn_thr=50, model_name=None):
+        """
+        Load the dense description embeddings (building them on first use) for the index of like_thr, dwn_thr.
+        Embeddings are L2-normalized and stored as a float16 matrix, memory-mapped and cached for the process.
+        :param model_name: (str) sentence-transformers model name, defaults to HF_EMBEDDING_MODEL
+        :return: (np.ndarray) (num datasets, dim) float16 embeddings, None if no dataset meets the criteria
+        """
+        if model_name is None: model_name = HF_EMBEDDING_MODEL
+        index = HFDataSearch.load_index(like_thr, dwn_thr)
+        if index is None:
+            return None
+        key = (like_thr, dwn_thr, model_name)
+        path = os.path.join(HFDataSearch.index_path(like_thr, dwn_thr),
+                            "dense_" + re.sub(r"[^A-Za-z0-9_.-]", "_", model_name) + ".npy")
+        with _HF_INDEX_LOCK:
+            if key in _HF_INDEX_CACHE:
+                return _HF_INDEX_CACHE[key]
+        if not os.path.exists(path):
+            embeddings = _hf_embedder(model_name).encode(
+                index["ds"]["description"], batch_size=64, normalize_embeddings=True, convert_to_numpy=True)
+            tmp_path = f"{path}.tmp{os.getpid()}_{threading.get_ident()}.npy"
+            np.save(tmp_path, embeddings.astype(np.float16))
+            os.replace(tmp_path, path)
+        with _HF_INDEX_LOCK:
+            _HF_INDEX_CACHE[key] = np.load(path, mmap_mode="r")
+            return _HF_INDEX_CACHE[key]
+
+    def dense_similarity(self, query, block=8192):
+        """
+        Cosine similarity of the query to every dataset description under the dense index
+        :param query: (str) search query
+        :param block: (int) rows upcast to float32 at a time
+        :return: (np.ndarray) similarities
+        """
+        query_vector = _hf_embedder(self.embedding_model).encode(
+            [query], normalize_embeddings=True, convert_to_numpy=True)[0].astype(np.float32)
+        return np.concatenate([np.asarray(self.dense_vectors[i:i + block], dtype=np.float32) @ query_vector
+                               for i in range(0, len(self.dense_vectors), block)])
+
+    @staticmethod
+    def _normalize(arr):
         min_val = arr.min()
         max_val = arr.max()
         if max_val - min_val == 0:
             return np.zeros_like(arr, dtype=float)
         return (arr - min_val) / (max_val - min_val)
 
-    def retrieve_ds(self, query, N=10, sim_w=1.0, like_w=0.0, dwn_w=0.0):
+    def retrieve_ds(self, query, N=10, sim_w=1.0, like_w=0.0, dwn_w=0.0, dense_w=None):
         """
         Retrieves the top N datasets matching the query, weighted by likes and downloads.
         :param query: The search query string.
@@ -93,6 +255,7 @@ class HFDataSearch:
         :param sim_w: Weight for cosine similarity.
         :param like_w: Weight for likes.
         :param dwn_w: Weight for downloads.
+        :param dense_w: Share of the cosine similarity from the dense index when loaded, defaults to HF_DENSE_WEIGHT.
         :return: List of top N dataset items.
         """
         if not self.ds or self.description_vectors is None:
@@ -103,47 +266,48 @@ class HFDataSearch:
         cosine_similarities = linear_kernel(query_vector, self.description_vectors).flatten()
         # Normalize cosine similarities
         cosine_similarities_norm = self._normalize(cosine_similarities)
+        if self.dense_vectors is not None:
+            if dense_w is None: dense_w = HF_DENSE_WEIGHT
+            dense_similarities_norm = self._normalize(self.dense_similarity(query))
+            cosine_similarities_norm = (1.0 - dense_w) * cosine_similarities_norm + dense_w * dense_similarities_norm
         # Compute final scores
         final_scores = (
                 sim_w * cosine_similarities_norm +
                 like_w * self.likes_norm +
                 dwn_w * self.downloads_norm
         )
-        # Get top N indices
-        top_indices = final_scores.argsort()[-N:][::-1]
+        # Get top N indices, partial sort of the N best only
+        N = min(N, len(final_scores))
+        top_indices = np.argpartition(-final_scores, N - 1)[:N]
+        top_indices = top_indices[np.argsort(-final_scores[top_indices], kind="stable")]
         # Convert indices to Python ints
         top_indices = [int(i) for i in top_indices]
-        top_datasets = [self.ds[i] for i in top_indices]
+        # one batched read of the selected rows
+        top_datasets = self.ds.select(top_indices).to_list()
         # check if dataset has a test & train set
         has_test_set = list()
         has_train_set = list()
         ds_size_info = list()
-        for i in top_indices:
-            try:
-                dbuilder = load_dataset_builder(self.ds[i]["id"], trust_remote_code=True).info
-            except Exception as e:
-                has_test_set.append(False)
-                has_train_set.append(False)
-                ds_size_info.append((None, None, None, None))
-                continue
-
-            if dbuilder.splits is None:
+        split_info = self.split_metadata([top_dataset["id"] for top_dataset in top_datasets])
+        for top_dataset in top_datasets:
+            splits = split_info.get(top_dataset["id"])
+            if splits is None:
                 has_test_set.append(False)
                 has_train_set.append(False)
                 ds_size_info.append((None, None, None, None))
                 continue
             # Print number of examples for
-            has_test, has_train = "test" in dbuilder.splits, "train" in dbuilder.splits
+            has_test, has_train = "test" in splits, "train" in splits
             has_test_set.append(has_test)
             has_train_set.append(has_train)
             test_dwn_size, test_elem_size = None, None
             train_dwn_size, train_elem_size = None, None
             if has_test:
-                test_dwn_size = bytes2human(dbuilder.splits["test"].num_bytes)
-                test_elem_size = dbuilder.splits["test"].num_examples
+                test_dwn_size = bytes2human(splits["test"]["num_bytes"])
+                test_elem_size = splits["test"]["num_examples"]
             if has_train:
-                train_dwn_size = bytes2human(dbuilder.splits["train"].num_bytes)
-                train_elem_size = dbuilder.splits["train"].num_examples
+                train_dwn_size = bytes2human(splits["train"]["num_bytes"])
+                train_elem_size = splits["train"]["num_examples"]
             ds_size_info.append((test_dwn_size, test_elem_size, train_dwn_size, train_elem_size))
         for _i in range(len(top_datasets)):
             top_datasets[_i]["has_test_set"] = has_test_set[_i]
@@ -154,6 +318,57 @@ class HFDataSearch:
             top_datasets[_i]["train_element_size"] = ds_size_info[_i][3]
         return top_datasets
 
+    @staticmethod
+    def _fetch_splits(dataset_id):
+        """
+        Look up the splits of a dataset on the huggingface hub
+        :param dataset_id: (str) dataset id
+        :return: (dict) split name -> {"num_bytes", "num_examples"}, or None if the dataset has no split info
+        """
+        splits = load_dataset_builder(dataset_id, trust_remote_code=True).info.splits
+        if splits is None:
+            return None
+        return {name: {"num_bytes": split.num_bytes, "num_examples": split.num_examples}
+                for name, split in splits.items()}
+
+    def split_metadata(self, dataset_ids, timeout=20.0):
+        """
+        Split metadata for several datasets, from the metadata cache or looked up concurrently,
+        one daemon thread per lookup so a hung lookup cannot block interpreter exit.
+        Lookups that fail or exceed the timeout are reported as None and not cached.
+        :param dataset_ids: (list(str)) dataset ids
+        :param timeout: (float) seconds each lookup may take
+        :return: (dict) dataset id -> split dict or None
+        """
+        cache = _hf_metadata_cache()
+        keys = {dataset_id: ResponseCache.make_key("hf_splits", dataset_id) for dataset_id in dataset_ids}
+        split_info = dict()
+        missing = list()
+        for dataset_id in dict.fromkeys(dataset_ids):
+            cached = cache.get(keys[dataset_id])
+            if cached is not None:
+                split_info[dataset_id] = json.loads(cached)
+            else:
+                missing.append(dataset_id)
+        fetched = dict()
+
+        def fetch(dataset_id):
+            try: fetched[dataset_id] = self._fetch_splits(dataset_id)
+            except Exception: pass
+
+        threads = {dataset_id: threading.Thread(target=fetch, args=(dataset_id,), daemon=True) for dataset_id in missing}
+        deadline = time.time() + timeout
+        for thread in threads.values(): thread.start()
+        for dataset_id, thread in threads.items():
+            # all lookups start together, so each one gets the full timeout
+            thread.join(max(0.0, deadline - time.time()))
+            split_info[dataset_id] = None
+            if thread.is_alive() or dataset_id not in fetched:
+                continue
+            split_info[dataset_id] = fetched[dataset_id]
+            cache.put(keys[dataset_id], json.dumps(split_info[dataset_id]))
+        return split_info
+
     def results_str(self, results):
         """
         Provide results as list of results in human-readable format.
@@ -285,6 +500,101 @@ class ArxivSearch:
         return pdf_text[:MAX_LEN]
 
 
+class PaperChunkIndex:
+    def __init__(self, chunk_chars=1500, overlap=200, n_features=2 ** 18):
+        """
+        Index of full-text papers split into chunks, to send only the passages relevant to a query instead of whole papers.
+        Chunks are hashed into term counts once when a paper is added (no vocabulary to refit), idf is recomputed on search.
+        :param chunk_chars: (int) approximate number of characters per chunk
+        :param overlap: (int) characters shared by consecutive chunks
+        :param n_features: (int) number of hashed term features
+        """
+        self.chunk_chars = chunk_chars
+        self.overlap = overlap
+        self.vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None, stop_words="english")
+        self.chunks = list()
+        self.papers = dict()
+        self._counts = None
+        self._weights = None
+        self._idf = None
+
+    def split(self, text):
+        """
+        Split a text into overlapping chunks, cutting at whitespace
+        :param text: (str) text to split
+        :return: (list) chunk strings
+        """
+        chunks, start = list(), 0
+        while start < len(text):
+            end = min(len(text), start + self.chunk_chars)
+            if end < len(text):
+                cut = max(text.rfind("\n", start + self.chunk_chars // 2, end), text.rfind(" ", start + self.chunk_chars // 2, end))
+                if cut != -1: end = cut
+            chunks.append(text[start:end].strip())
+            if end >= len(text): break
+            start = max(end - self.overlap, start + 1)
+        return [chunk for chunk in chunks if chunk]
+
+    def add_paper(self, paper_id, text):
+        """
+        Chunk and index a paper, papers already in the index are skipped
+        :param paper_id: (str) paper identifier, e.g. arXiv ID
+        :param text: (str) full text of the paper
+        :return: (int) number of chunks of the paper
+        """
+        if paper_id in self.papers: return len(self.papers[paper_id])
+        chunks = self.split(text)
+        if len(chunks) == 0: return 0
+        self.papers[paper_id] = list(range(len(self.chunks), len(self.chunks) + len(chunks)))
+        self.chunks += [(paper_id, _i, chunk) for _i, chunk in enumerate(chunks)]
+        counts = self.vectorizer.transform(chunks).tocsr()
+        counts.data = np.log1p(counts.data)
+        self._counts = counts if self._counts is None else sparse.vstack([self._counts, counts]).tocsr()
+        self._weights = None
+        return len(chunks)
+
+    def search(self, query, k=4, paper_id=None, exclude=()):
+        """
+        Chunks most similar to a query by tf-idf cosine similarity
+        :param query: (str) query text
+        :param k: (int) number of chunks
+        :param paper_id: (str) only search the chunks of this paper, None for every paper
+        :param exclude: (iterable) chunk indices to leave out
+        :return: (list) (chunk index, paper id, chunk number, text) of the top k chunks, best first
+        """
+        if self._counts is None: return []
+        if self._weights is None:
+            # every chunk holds a column at most once, so column occurrences are document frequencies
+            df = np.bincount(self._counts.indices, minlength=self._counts.shape[1])
+            self._idf = np.log((1 + self._counts.shape[0]) / (1 + df)) + 1
+            self._weights = normalize(self._counts.multiply(self._idf).tocsr())
+        query_vec = self.vectorizer.transform([query])
+        query_vec.data = np.log1p(query_vec.data)
+        query_vec = normalize(query_vec.multiply(self._idf).tocsr())
+        scores = (self._weights @ query_vec.T).toarray().ravel()
+        candidates = self.papers.get(paper_id, []) if paper_id is not None else range(len(self.chunks))
+        exclude = set(exclude)
+        candidates = [_i for _i in candidates if _i not in exclude]
+        candidates.sort(key=lambda _i: scores[_i], reverse=True)
+        return [(_i,) + self.chunks[_i] for _i in candidates[:k]]
+
+    def format_excerpts(self, results):
+        """
+        Format search results for a prompt, in the order they appear in their paper
+        :param results: (list) results of search
+        :return: (str) excerpts
+        """
+        results = sorted(results, key=lambda result: (result[1], result[2]))
+        return "\n".join([f"[{_paper_id}, part {_num + 1} of {len(self.papers[_paper_id])}]\n{text}" for _, _paper_id, _num, text in results])
+
+    def excerpts(self, query, k=4, paper_id=None, exclude=()):
+        """
+        Top k chunks for a query formatted for a prompt, see search and format_excerpts
+        :return: (str) excerpts
+        """
+        return self.format_excerpts(self.search(query, k, paper_id, exclude))
+
+
 # Set the non-interactive backend early in the module
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -310,6 +620,8 @@ def execute_code(code_str, timeout=600, MAX_LEN=1000):
         return "[CODE EXECUTION ERROR] pubmed Download took way too long. Program terminated"
     if "exit(" in code_str:
         return "[CODE EXECUTION ERROR] The exit() command is not allowed you must remove this."
+    # query_* answers are memoized across runs, so re-running unchanged prompts is instant
+    os.environ.setdefault("AGENTLAB_EXPERIMENT_CACHE", os.path.abspath(os.path.join(CACHE_DIR, "experiment_llm.sqlite")))
     output_queue = multiprocessing.Queue()
     proc = multiprocessing.Process(target=worker_run_code, args=(code_str, output_queue))
     proc.start()
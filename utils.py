@@ -1,127 +1,192 @@
 import os, re
 import shutil
 import time
+import threading
 import tiktoken, openai
 import subprocess, string
 from openai import OpenAI
+from inference import RETRY_POLICY, CACHE_DIR, ResponseCache, get_client, configure_gemini
 import google.generativeai as genai
 from huggingface_hub import InferenceClient
-
-
-def query_deepseekv3(prompt, system, api_key, attempt=0, temperature=0.0):
-    try:
-        client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": prompt},
-            ],
-            stream=False, temperature=temperature,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        print(f"Query qwen error: {e}")
-        if attempt >= 10: return f"Your attempt to query deepseekv3 failed: {e}"
-        return query_deepseekv3(prompt, system, attempt+1)
-
-
-def query_qwen(prompt, system, api_key, attempt=0, temperature=0.0):
-    try:
-        client = InferenceClient(api_key=api_key)
-        if system is not None:
-            messages = [
-                {"role": "system", "content": system},
-                {"role": "user", "content": prompt}]
-        else:
-            messages = [
-                {"role": "user", "content": prompt}]
-
-        completion = client.chat.completions.create(
-            model="Qwen/QwQ-32B",
-            messages=messages,
-            max_tokens=500,
-            temperature=temperature
-        )
-        return completion.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Query qwen error: {e}")
-        if attempt >= 10: return f"Your attempt to inference gemini failed: {e}"
-        return query_qwen(prompt, system, attempt+1)
-
-
-def query_gpt4omini(prompt, system, api_key, attempt=0, temperature=0.0):
-    try:
-        openai_api_key = api_key
-        openai.api_key = openai_api_key
-        os.environ["OPENAI_API_KEY"] = openai_api_key
-        if system is not None:
-            messages = [
-                {"role": "system", "content": system},
-                {"role": "user", "content": prompt}]
-        else:
-            messages = [
-                {"role": "user", "content": prompt}]
-        client = OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", messages=messages, temperature=temperature).choices[0].message.content.strip()
-        return response
-    except Exception as e:
-        print(f"Query 4o-mini error: {e}")
-        if attempt >= 10: return f"Your attempt to inference gemini failed: {e}"
-        return query_gpt4omini(prompt, system, attempt+1)
-
-
-
-def query_gpt4o(prompt, system, api_key, attempt=0, temperature=0.0):
-    try:
-        openai_api_key = api_key
-        openai.api_key = openai_api_key
-        os.environ["OPENAI_API_KEY"] = openai_api_key
-        if system is not None:
-            messages = [
-                {"role": "user", "content":system + prompt}]
-        else:
-            messages = [
-                {"role": "user", "content": prompt}]
-        client = OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4o", messages=messages, temperature=temperature).choices[0].message.content.strip()
-        return response
-    except Exception as e:
-        print(f"Query gpr-4o error: {e}")
-        if attempt >= 10: return f"Your attempt to inference gemini failed: {e}"
-        return query_gpt4o(prompt, system, attempt+1)
-
-
-
-def query_gemini(prompt, system, api_key, attempt=0, temperature=0.0):
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name="gemini-1.5-pro", system_instruction=system)
-        response = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(temperature=temperature)).text.strip()
-        time.sleep(1)
-        return response
-    except Exception as e:
-        print(f"Gemini error: {e}")
-        if attempt >= 10: return f"Your attempt to inference gemini failed: {e}"
-        time.sleep(1)
-        return query_gemini(prompt, system, attempt+1)
-
-
-
-def query_gemini2p0(prompt, system, api_key, attempt=0, temperature=0.0,):
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(model_name="gemini-2.0-flash", system_instruction=system)
-        response = model.generate_content(prompt, generation_config=genai.types.GenerationConfig(temperature=temperature)).text.strip()
-        time.sleep(1)
-        return response
-    except Exception as e:
-        print(f"Gemini error: {e}")
-        if attempt >= 10: return f"Your attempt to inference gemini failed: {e}"
-        time.sleep(1)
-        return query_gemini2p0(prompt, system, attempt+1)
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+_HF_CLIENTS = dict()
+# the children forked by execute_code get their own clients, like the pool in inference.get_client
+if hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=_HF_CLIENTS.clear)
+# memo cache of the query_* helpers inside experiment code, see _experiment_cache
+_EXPERIMENT_CACHE = None
+_EXPERIMENT_CACHE_PID = None
+_QUERY_OCCURRENCES = dict()
+_QUERY_OCCURRENCES_LOCK = threading.Lock()
+
+
+def _experiment_cache():
+    """
+    Memo cache for the query_* helpers, at the path in AGENTLAB_EXPERIMENT_CACHE (set by execute_code)
+    Opened once per process, sqlite connections must not be shared with forked children.
+    @return: (ResponseCache) cache, None when AGENTLAB_EXPERIMENT_CACHE is unset or empty
+    """
+    global _EXPERIMENT_CACHE, _EXPERIMENT_CACHE_PID
+    path = os.getenv("AGENTLAB_EXPERIMENT_CACHE")
+    if not path:
+        return None
+    with _QUERY_OCCURRENCES_LOCK:
+        if _EXPERIMENT_CACHE_PID != os.getpid() or _EXPERIMENT_CACHE.path != path:
+            _EXPERIMENT_CACHE = ResponseCache(path)
+            _EXPERIMENT_CACHE_PID = os.getpid()
+            _QUERY_OCCURRENCES.clear()
+    return _EXPERIMENT_CACHE
+
+
+def _memo_key(model, system, prompt, temperature):
+    """
+    Cache key of a query_* call. Sampled calls (temperature > 0) also count how often the same
+    request was made in this process, so repeated samples stay distinct while a re-run of the
+    experiment gets the same samples back from the cache.
+    @return: (str) cache key
+    """
+    key = ResponseCache.make_key(model, system, prompt, temperature)
+    if not temperature:
+        return key
+    with _QUERY_OCCURRENCES_LOCK:
+        occurrence = _QUERY_OCCURRENCES.get(key, 0)
+        _QUERY_OCCURRENCES[key] = occurrence + 1
+    return ResponseCache.make_key(key, occurrence)
+
+
+def _retry_query(request, name, failure, attempt=0, memo=None):
+    """
+    Run a model request, backing off with RETRY_POLICY between failed attempts
+    @param request: (callable) sends the request and returns the answer
+    @param name: (str) model name printed with errors
+    @param failure: (str) start of the message returned when every attempt failed
+    @param attempt: (int) attempts already made
+    @param memo: (tuple) (model, system, prompt, temperature) to look up and store the answer in the experiment cache
+    @return: (str) answer, or the failure message after 10 retries or a bad request
+    """
+    cache = _experiment_cache() if memo is not None else None
+    key = _memo_key(*memo) if cache is not None else None
+    if key is not None:
+        answer = cache.get(key)
+        if answer is not None: return answer
+    while True:
+        try:
+            answer = request()
+            if key is not None and answer is not None: cache.put(key, answer)
+            return answer
+        except Exception as e:
+            print(f"Query {name} error: {e}")
+            if attempt >= 10 or RETRY_POLICY.classify(e) == "bad_request": return f"{failure}: {e}"
+            time.sleep(RETRY_POLICY.delay(attempt, e))
+            attempt += 1
+
+
+def query_deepseekv3(prompt, system, api_key=None, attempt=0, temperature=0.0):
+    api_key = api_key or os.getenv("DEEPSEEK_API_KEY")
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt}]
+    return _retry_query(
+        lambda: get_client("deepseek", api_key).chat.completions.create(model="deepseek-chat", messages=messages, stream=False, temperature=temperature).choices[0].message.content,
+        "deepseekv3", "Your attempt to query deepseekv3 failed", attempt, ("deepseek-chat", system, prompt, temperature))
+
+
+def query_qwen(prompt, system, api_key=None, attempt=0, temperature=0.0):
+    api_key = api_key or os.getenv("HF_TOKEN")
+    if api_key not in _HF_CLIENTS: _HF_CLIENTS[api_key] = InferenceClient(api_key=api_key)
+    if system is not None:
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}]
+    else:
+        messages = [
+            {"role": "user", "content": prompt}]
+    return _retry_query(
+        lambda: _HF_CLIENTS[api_key].chat.completions.create(model="Qwen/QwQ-32B", messages=messages, max_tokens=500, temperature=temperature).choices[0].message.content.strip(),
+        "qwen", "Your attempt to inference qwen failed", attempt, ("Qwen/QwQ-32B", system, prompt, temperature))
+
+
+def query_gpt4omini(prompt, system, api_key=None, attempt=0, temperature=0.0):
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if system is not None:
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}]
+    else:
+        messages = [
+            {"role": "user", "content": prompt}]
+    return _retry_query(
+        lambda: get_client("openai", api_key).chat.completions.create(model="gpt-4o-mini", messages=messages, temperature=temperature).choices[0].message.content.strip(),
+        "4o-mini", "Your attempt to inference gpt-4o-mini failed", attempt, ("gpt-4o-mini", system, prompt, temperature))
+
+
+def query_gpt4o(prompt, system, api_key=None, attempt=0, temperature=0.0):
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if system is not None:
+        messages = [
+            {"role": "user", "content": system + prompt}]
+    else:
+        messages = [
+            {"role": "user", "content": prompt}]
+    return _retry_query(
+        lambda: get_client("openai", api_key).chat.completions.create(model="gpt-4o", messages=messages, temperature=temperature).choices[0].message.content.strip(),
+        "gpt-4o", "Your attempt to inference gpt-4o failed", attempt, ("gpt-4o", system, prompt, temperature))
+
+
+def _query_gemini_model(model_name, prompt, system, api_key, attempt, temperature):
+    configure_gemini(api_key or os.getenv("GEMINI_API_KEY"))
+    model = genai.GenerativeModel(model_name=model_name, system_instruction=system)
+    return _retry_query(
+        lambda: model.generate_content(prompt, generation_config=genai.types.GenerationConfig(temperature=temperature)).text.strip(),
+        model_name, "Your attempt to inference gemini failed", attempt, (model_name, system, prompt, temperature))
+
+
+def query_gemini(prompt, system, api_key=None, attempt=0, temperature=0.0):
+    return _query_gemini_model("gemini-1.5-pro", prompt, system, api_key, attempt, temperature)
+
+
+def query_gemini2p0(prompt, system, api_key=None, attempt=0, temperature=0.0,):
+    return _query_gemini_model("gemini-2.0-flash", prompt, system, api_key, attempt, temperature)
+
+
+# model name -> query helper used by batch_query
+BATCH_QUERY_MODELS = {
+    "gpt-4o-mini": query_gpt4omini,
+    "gpt-4o": query_gpt4o,
+    "deepseek-chat": query_deepseekv3,
+    "gemini-1.5-pro": query_gemini,
+    "gemini-2.0-flash": query_gemini2p0,
+    "qwen": query_qwen,
+}
+
+
+def batch_query(prompts, system, model="gpt-4o-mini", max_concurrency=16, temperature=0.0, api_key=None, print_every=50):
+    """
+    Query a language model with many prompts concurrently
+    e.g. answers = batch_query([ex["problem"] for ex in dataset], system="You are a skilled mathematician.")
+    @param prompts: (list) prompts, one request each
+    @param system: (str) system prompt shared by every request
+    @param model: (str) one of BATCH_QUERY_MODELS
+    @param max_concurrency: (int) max number of requests in flight
+    @param temperature: (float) sampling temperature
+    @param api_key: (str) api key, defaults to the provider environment variable
+    @param print_every: (int) print progress every print_every answers
+    @return: (list) answers in the order of prompts, failed requests hold their error message
+    """
+    if model not in BATCH_QUERY_MODELS:
+        raise Exception(f"Unknown model: {model}, batch_query supports {list(BATCH_QUERY_MODELS)}")
+    query = BATCH_QUERY_MODELS[model]
+    answers = [None] * len(prompts)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {executor.submit(query, prompt, system, api_key, 0, temperature): i for i, prompt in enumerate(prompts)}
+        for done, future in enumerate(as_completed(futures), 1):
+            try: answers[futures[future]] = future.result()
+            except Exception as e: answers[futures[future]] = f"[BATCH QUERY ERROR]: {e}"
+            if done % print_every == 0 or done == len(prompts):
+                print(f"batch_query: {done}/{len(prompts)} answers ({time.time() - start:.1f}s)")
+    return answers
 
 
 def compile_latex(latex_code, output_path, compile=True, timeout=30):
@@ -238,6 +303,42 @@ def extract_prompt(text, word):
     extracted_code = "\n".join(code_blocks).strip()
     return extracted_code
 
+
+_COMMAND_NAME_PATTERN = re.compile(r"[A-Z][A-Z_]*\b")
+
+
+def command_block_closed(text, skip=()):
+    """
+    Stop predicate for query_model: true once the first ```COMMAND block has been closed,
+    the solvers only act on that block so the rest of the answer can be skipped.
+    Fences are paired in order, and a block is a command when its opening fence is directly followed
+    by the command name, as extract_prompt reads it.
+    >>> command_block_closed("```python\\nx=1\\n```\\nI will now REPLACE:\\n```REPLACE\\nfoo")
+    False
+    >>> command_block_closed("```\\nX = 1\\n```\\n```REPLACE\\nfoo")
+    False
+    >>> command_block_closed("```\\nX = 1\\n```\\n```REPLACE\\nfoo\\n```")
+    True
+    @param text: (str) answer received so far
+    @param skip: (tuple) commands whose blocks do not end the answer
+    @return: (bool) whether a command block was closed
+    """
+    fences = [match.start() for match in re.finditer("```", text)]
+    for open_pos in fences[0:-1:2]:
+        name = _COMMAND_NAME_PATTERN.match(text, open_pos + 3)
+        if name is not None and name.group(0) not in skip: return True
+    return False
+
+
+def action_block_closed(text):
+    """
+    Stop predicate for agents in the workflow phases, which read a ```DIALOGUE block and the phase
+    command (PLAN, SUBMIT_CODE, SEARCH_HF, ...) from the same answer: true once a non-DIALOGUE block has been closed
+    @param text: (str) answer received so far
+    @return: (bool) whether a command block other than DIALOGUE was closed
+    """
+    return command_block_closed(text, skip=("DIALOGUE",))
+
 from typing import Dict, List
 
 import datasets